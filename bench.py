@@ -0,0 +1,185 @@
+"""Бенчмарки бота, работают без сети.
+
+    python bench.py draw                # стоимость розыгрыша для пулов до 100 000 ответов
+    python bench.py draw --output draw.json
+    python bench.py handlers            # обработчики против заменителей Google Диска и Bot API
+    python bench.py handlers --chats 1,10 --answers 100 --users 5 --drive-latency 0.1 --output handlers.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+# Журнал и задержка записи отключаются до импорта бота: конфигурация читается при импорте
+os.environ.setdefault("JOURNAL_FILE", "")
+os.environ.setdefault("FLUSH_DELAY", "0.05")
+os.environ.setdefault("STORAGE_BACKEND", "drive")
+
+import main  # noqa: E402
+from fakes import FakeBot, FakeDrive  # noqa: E402
+
+ADMIN_ID = 1  # Пользователь из белого списка, от имени которого идут команды
+
+
+def bench_draw(sizes=(1000, 10000, 100000), draws=2000, winners=3):
+    """Среднее время одного розыгрыша (в микросекундах) для разных размеров пула.
+
+    Кроме пулов, где у каждого участника по 5 ответов, проверяются пулы с
+    несколькими участниками, у которых почти все ответы.
+    """
+    results = []
+    for size in sizes:
+        for users in (max(size // 5, 1), 10, 2):
+            for weighted in (False, True):
+                state = main.ChatState(0)
+                for number in range(size):
+                    state.add_answer(number % users, f"ответ {number}")
+                if weighted:
+                    # Каждому десятому участнику (и первому) - тройной вес
+                    for user_id in range(0, users, 10):
+                        state.set_user_weight(user_id, 3)
+                for count in (1, winners):
+                    started = time.perf_counter()
+                    for _ in range(draws):
+                        state.draw(count)
+                    elapsed = time.perf_counter() - started
+                    results.append({
+                        "pool": size,
+                        "users": users,
+                        "weighted": weighted,
+                        "winners": count,
+                        "us_per_draw": round(elapsed / draws * 1e6, 2),
+                    })
+    return results
+
+
+def percentile(values, q):
+    """Квантиль q отсортированного списка (ближайший ранг)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def play_chat(bot, chat_id, answers, users, latencies):
+    """Типичная игра в одном чате: ответы, таблица, удаления, розыгрыши, исключение."""
+    async def call(handler, text, **kwargs):
+        update, context = bot.update(chat_id, ADMIN_ID, text, **kwargs)
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.setdefault(handler.__name__, []).append(time.perf_counter() - started)
+
+    first_user = chat_id * 1000
+    for i in range(answers):
+        await call(main.add_answer, "++", reply_user_id=first_user + i % users, reply_text=f"ответ {i}")
+        if i % 10 == 9:
+            await call(main.show_leaderboard, "/rprlb")
+    for number in range(1, answers + 1, 10):
+        await call(main.remove_answer, f"/minus {number}", args=[str(number)])
+    for _ in range(3):
+        await call(main.roll_winner, "/rpr")
+    await call(main.modify_roll, f"мрр {first_user}", args=[str(first_user)])
+    await call(main.roll_winner, "/rpr")
+    await call(main.show_leaderboard, "/rprlb")
+
+
+async def run_handlers(chats, answers, users, drive_latency, bot_latency):
+    """Один прогон: свежие заменители и кэши, все чаты параллельно."""
+    drive = FakeDrive(drive_latency)
+    bot = FakeBot(bot_latency)
+    main.get_gdrive_service = lambda: drive
+    main.file_ids.clear()
+    main.state_cache = main.ChatStateCache()
+    main.name_resolver = main.NameResolver()
+    main.whitelist.add(ADMIN_ID)
+
+    latencies = {}
+    started = time.perf_counter()
+    await asyncio.gather(*(play_chat(bot, chat_id, answers, users, latencies) for chat_id in range(1, chats + 1)))
+    elapsed = time.perf_counter() - started
+    flush_started = time.perf_counter()
+    await main.state_flusher.drain()
+    flush = time.perf_counter() - flush_started
+
+    results = []
+    everything = sorted(value for values in latencies.values() for value in values)
+    for handler, values in [("all", everything)] + sorted(latencies.items()):
+        values = sorted(values)
+        results.append({
+            "chats": chats,
+            "answers": answers,
+            "users": users,
+            "handler": handler,
+            "ops": len(values),
+            "ops_per_s": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        })
+    results[0].update({"drive_calls": drive.calls, "bot_calls": bot.calls, "flush_s": round(flush, 3)})
+    return results
+
+
+def bench_handlers(chats=(1, 10, 50), answers=(25, 100), users=(5, 25), drive_latency=0.05, bot_latency=0.02):
+    """Пропускная способность и задержки обработчиков для разных нагрузок."""
+    main.FILE_IDS_FILE = os.path.join(tempfile.mkdtemp(), "file_ids.json")
+    results = []
+    for chat_count in chats:
+        for answer_count in answers:
+            for user_count in users:
+                results.extend(asyncio.run(run_handlers(chat_count, answer_count, user_count, drive_latency, bot_latency)))
+    return results
+
+
+def current_commit():
+    """Коммит, на котором запущен бенчмарк (для сравнения результатов)."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def print_table(results):
+    """Вывод результатов таблицей."""
+    columns = list(dict.fromkeys(column for row in results for column in row))
+    print("  ".join(f"{column:>12}" for column in columns))
+    for row in results:
+        print("  ".join(f"{str(row.get(column, '')):>12}" for column in columns))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument("suite", choices=["draw", "handlers"], help="набор бенчмарков")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--chats", type=int_list, default=[1, 10, 50], help="число чатов, через запятую")
+    parser.add_argument("--answers", type=int_list, default=[25, 100], help="ответов в игре, через запятую")
+    parser.add_argument("--users", type=int_list, default=[5, 25], help="участников в чате, через запятую")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="задержка запроса к Google Диску, секунд")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="задержка вызова Bot API, секунд")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    if args.suite == "draw":
+        params = {}
+        results = bench_draw()
+    else:
+        params = {"chats": args.chats, "answers": args.answers, "users": args.users,
+                  "drive_latency": args.drive_latency, "bot_latency": args.bot_latency}
+        results = bench_handlers(**params)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"suite": args.suite, "commit": current_commit(), "params": params, "results": results},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
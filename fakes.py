@@ -0,0 +1,272 @@
+"""Заменители Google Drive API и Telegram Bot API для бенчмарков без сети.
+
+Задержка ответа настраивается: запросы к Google Диску ждут в потоке
+(time.sleep), как настоящий блокирующий клиент, а запросы к Bot API - в
+цикле событий (asyncio.sleep).
+"""
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import httplib2
+from googleapiclient.errors import HttpError
+from telegram.request import BaseRequest
+
+
+class FakeRequest:
+    """Отложенный запрос с методом execute, как у googleapiclient."""
+
+    def __init__(self, drive, func, method=None):
+        self._drive = drive
+        self._func = func
+        self.method = method
+
+    def execute(self, num_retries=0):
+        if self._drive.latency:
+            time.sleep(self._drive.latency)
+        with self._drive.lock:
+            self._drive.calls += 1
+            self._drive.check_failure(self.method)
+            return self._func()
+
+
+class FakeBatch:
+    """Пакетный запрос: один вызов с одной задержкой на все вложенные запросы."""
+
+    def __init__(self, drive, callback=None):
+        self._drive = drive
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request, callback or self._callback, request_id or str(len(self._requests))))
+
+    def execute(self):
+        if self._drive.latency:
+            time.sleep(self._drive.latency)
+        with self._drive.lock:
+            self._drive.calls += 1
+            self._drive.batches += 1
+            for request, callback, request_id in self._requests:
+                try:
+                    self._drive.check_failure(request.method)
+                    response, exception = request._func(), None
+                except HttpError as error:
+                    response, exception = None, error
+                if callback:
+                    callback(request_id, response, exception)
+
+
+class FakeFiles:
+    """Ресурс files() с методами, которые использует бот."""
+
+    def __init__(self, drive):
+        self._drive = drive
+
+    def _get(self, file_id):
+        file = self._drive.stored.get(file_id)
+        if file is None:
+            raise HttpError(httplib2.Response({"status": 404}), b"File not found")
+        return file
+
+    def list(self, q="", fields=None, pageSize=100, pageToken=None, orderBy=None):
+        def run():
+            exact = re.search(r"name='([^']*)'", q)
+            contains = re.search(r"name contains '([^']*)'", q)
+            names = [(file_id, file["name"]) for file_id, file in self._drive.stored.items()
+                     if (not exact or file["name"] == exact.group(1))
+                     and (not contains or contains.group(1) in file["name"])]
+            if orderBy == "modifiedTime desc":
+                names.sort(key=lambda item: self._drive.stored[item[0]]["modified"], reverse=True)
+            start = int(pageToken or 0)
+            page = names[start:start + pageSize]
+            result = {"files": [{"id": file_id, "name": name} for file_id, name in page]}
+            if start + pageSize < len(names):
+                result["nextPageToken"] = str(start + pageSize)
+            return result
+        return FakeRequest(self._drive, run, "list")
+
+    def get_media(self, fileId):
+        return FakeRequest(self._drive, lambda: self._get(fileId)["content"], "get_media")
+
+    def update(self, fileId, media_body=None, body=None):
+        def run():
+            file = self._get(fileId)
+            if media_body is not None:
+                file["content"] = media_body.getbytes(0, media_body.size())
+            file["modified"] = next(self._drive.ids)
+            return {"id": fileId}
+        return FakeRequest(self._drive, run, "update")
+
+    def create(self, body, media_body=None, fields=None):
+        def run():
+            file_id = f"fake{next(self._drive.ids)}"
+            content = media_body.getbytes(0, media_body.size()) if media_body is not None else b""
+            self._drive.stored[file_id] = {"name": body["name"], "content": content, "modified": next(self._drive.ids)}
+            return {"id": file_id}
+        return FakeRequest(self._drive, run, "create")
+
+    def delete(self, fileId):
+        return FakeRequest(self._drive, lambda: self._drive.stored.pop(fileId, None) and None, "delete")
+
+
+class FakeDrive:
+    """Google Drive v3 в памяти."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Секунд на каждый запрос
+        self.stored = {}  # ID -> {"name", "content"}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.batches = 0
+        self.failures = {}  # Метод files() -> [HTTP-статус, сколько раз еще отказать]
+
+    def fail(self, method, status=503, times=1):
+        """Следующие times вызовов метода (list, get_media, update, create, delete) завершатся HttpError."""
+        self.failures[method] = [status, times]
+
+    def check_failure(self, method):
+        failure = self.failures.get(method)
+        if failure:
+            failure[1] -= 1
+            if not failure[1]:
+                del self.failures[method]
+            raise HttpError(httplib2.Response({"status": failure[0]}), b"Injected failure")
+
+    def files(self):
+        return FakeFiles(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+class FakeMessage:
+    """Сообщение с reply_text, отправляющим ответ через FakeBot."""
+
+    def __init__(self, bot, chat, user, text, reply_to_message=None, message_id=None):
+        self._bot = bot
+        self.chat = chat
+        self.from_user = user
+        self.sender_chat = None
+        self.text = text
+        self.reply_to_message = reply_to_message
+        self.message_id = message_id or next(bot.message_ids)
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat.id, text, **kwargs)
+
+
+class FakeBot:
+    """context.bot в памяти: считает вызовы и выдерживает заданную задержку."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Секунд на каждый вызов Bot API
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+        self.sent = 0
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    @staticmethod
+    def user(user_id):
+        return SimpleNamespace(id=user_id, username=f"user{user_id}", full_name=f"User {user_id}",
+                               first_name=f"User {user_id}", is_bot=False)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        self.sent += 1
+        return FakeMessage(self, SimpleNamespace(id=chat_id, type="group"), self.user(0), text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call()
+        return True
+
+    async def get_chat(self, chat_id):
+        await self._call()
+        return self.user(chat_id)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call()
+        return SimpleNamespace(user=self.user(user_id), status="member")
+
+    async def get_chat_administrators(self, chat_id):
+        await self._call()
+        return []
+
+    async def pin_chat_message(self, *args, **kwargs):
+        await self._call()
+        return True
+
+    async def delete_message(self, *args, **kwargs):
+        await self._call()
+        return True
+
+    def update(self, chat_id, user_id, text, reply_user_id=None, reply_text="ответ", args=None):
+        """Пара (update, context) для вызова обработчика напрямую."""
+        chat = SimpleNamespace(id=chat_id, type="group")
+        user = self.user(user_id)
+        reply = None
+        if reply_user_id is not None:
+            reply = FakeMessage(self, chat, self.user(reply_user_id), reply_text)
+        message = FakeMessage(self, chat, user, text, reply)
+        update = SimpleNamespace(update_id=message.message_id, effective_chat=chat, effective_user=user,
+                                 message=message, effective_message=message)
+        context = SimpleNamespace(bot=self, args=list(args or []))
+        return update, context
+
+
+class FakeBotRequest(BaseRequest):
+    """Транспорт Bot API без сети: настоящий telegram.Bot получает правдоподобные ответы.
+
+    Используется replay.py, чтобы обновления проходили через настоящее
+    Application и его обработчики.
+    """
+
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "rplusr", "username": "rplusr_bot"}
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Секунд на каждый вызов Bot API
+        self.message_ids = itertools.count(1)
+        self.calls = {}  # Метод API -> число вызовов
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, endpoint, parameters):
+        chat_id = parameters.get("chat_id", 0)
+        if endpoint in ("sendMessage", "editMessageText"):
+            return {"message_id": parameters.get("message_id") or next(self.message_ids), "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                    "from": self.BOT_USER, "text": parameters.get("text", "")}
+        if endpoint == "getMe":
+            return dict(self.BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if endpoint == "getChat":
+            return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+        if endpoint == "getChatMember":
+            user_id = parameters.get("user_id", 0)
+            user_id = user_id if isinstance(user_id, int) else 0
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}}
+        if endpoint in ("getChatAdministrators", "getUpdates"):
+            return []
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency and endpoint != "getMe":
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, parameters)}).encode()
@@ -1,20 +1,75 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # Начало импорта main.py, от него считаются этапы запуска
 import os
+import sys
+import importlib
 import logging
 import random
 import json
 import io
+import math
+import re
+import sqlite3
+import threading
+import asyncio
+import functools
+import contextlib
+import hashlib
+import hmac
+import signal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+startup_marks = [("импорт стандартной библиотеки", time.perf_counter())]  # (этап, момент его окончания)
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, MessageHandler, TypeHandler, filters, CallbackContext
+startup_marks.append(("импорт python-telegram-bot", time.perf_counter()))
+# Клиент Google Drive импортируется при первом обращении к Google Диску (см. DRIVE_CLIENT_MODULES)
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload
 
 # Конфигурация
 TOKEN = os.getenv("BOT_TOKEN")
 WHITELIST_FILE = "whitelist.json"
+FILE_IDS_FILE = "file_ids.json"  # Локальный индекс имя файла -> ID на Google Диске
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 BASE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID") # Опционально: ID папки на Google Диске
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "drive")  # Хранилище состояний: drive или sqlite
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot_state.sqlite3")  # Файл базы для STORAGE_BACKEND=sqlite
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+DRIVE_HTTP_TIMEOUT = int(os.getenv("DRIVE_HTTP_TIMEOUT", "30"))  # Секунд на один запрос к Google Диску
+DRIVE_WORKERS = int(os.getenv("DRIVE_WORKERS", "8"))  # Потоков для запросов к Google Диску
+DRIVE_BATCH_SIZE = min(int(os.getenv("DRIVE_BATCH_SIZE", "50")), 100)  # Запросов в одном пакете (batch) Google Drive API, не больше 100
+DRIVE_BATCH_WINDOW = float(os.getenv("DRIVE_BATCH_WINDOW", "0.05"))  # Секунд, за которые сохранения разных чатов собираются в пакет
+DRIVE_BATCH_RETRIES = int(os.getenv("DRIVE_BATCH_RETRIES", "3"))  # Повторов для запросов пакета, завершившихся ошибкой
+FLUSH_DELAY = float(os.getenv("FLUSH_DELAY", "2"))  # Секунд, за которые изменения чата собираются в одну загрузку
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "")  # Локальный журнал операций (например journal.jsonl); по умолчанию выключен, см. README
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"  # fsync после каждой записи в журнал
+JOURNAL_COMPACT_LINES = int(os.getenv("JOURNAL_COMPACT_LINES", "5000"))  # Устаревших строк до перезаписи журнала
+SNAPSHOT_EVERY_OPS = int(os.getenv("SNAPSHOT_EVERY_OPS", "50"))  # Операций чата до снимка на Google Диск
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))  # Секунд до снимка на Google Диск при включенном журнале
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", "21600"))  # Секунд хранения имени пользователя
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", "10000"))  # Максимум имен в кэше
+NAME_RESOLVE_CONCURRENCY = int(os.getenv("NAME_RESOLVE_CONCURRENCY", "8"))  # Параллельных запросов get_chat
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "600"))  # Секунд хранения списка администраторов чата
+CHAT_ADMINS_AUTHORIZED = os.getenv("CHAT_ADMINS_AUTHORIZED", "1") == "1"  # Администраторы чата управляют ботом без белого списка
+LIVE_LEADERBOARD = os.getenv("LIVE_LEADERBOARD", "0") == "1"  # Живая таблица лидеров по умолчанию для новых чатов
+PLUS_FULL_LEADERBOARD_MAX = int(os.getenv("PLUS_FULL_LEADERBOARD_MAX", "100"))  # Ответов в игре, до которых после ++ выводится полная таблица
+PLUS_TOP_PLACES = int(os.getenv("PLUS_TOP_PLACES", "10"))  # Мест в таблице после ++ в играх крупнее этого порога
+LIVE_EDIT_DELAY = float(os.getenv("LIVE_EDIT_DELAY", "3"))  # Секунд, за которые правки живой таблицы собираются в одну
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+STATE_VERSION = 2  # Версия схемы файлов состояния
+MANIFEST_VERSION = 3  # Версия манифеста игры, ответы которой хранятся сегментами
+ANSWER_SEGMENT_SIZE = int(os.getenv("ANSWER_SEGMENT_SIZE", "500"))  # Ответов в одном сегменте на Google Диске
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))  # Обновлений из разных чатов, обрабатываемых одновременно
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес бота (https://...); если задан, бот работает через webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")  # Путь, на который Telegram присылает обновления
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Секрет заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена
+PORT = int(os.getenv("PORT", "8443"))  # Порт HTTP-сервера в режиме webhook
+METRICS_PORT = os.getenv("METRICS_PORT")  # Порт /metrics и /healthz в режиме polling (в режиме webhook они на $PORT)
+RECORD_UPDATES_FILE = os.getenv("RECORD_UPDATES_FILE")  # JSONL для записи входящих обновлений (обезличенных) для replay.py
+RECORD_SALT = os.getenv("RECORD_SALT")  # Ключ обезличивания ID и имен; по умолчанию выводится из токена
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "4096"))  # Обновлений в обработке, включая ждущих очереди своего чата (остальные ждут задачей PTB, это не предел очереди)
 
 # Настройки логирования
 logging.basicConfig(
@@ -22,20 +77,216 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
-
-# Глобальные переменные для хранения состояния (теперь будут загружаться из Google Диска)
-user_answers = {}
-answer_list = []
-roll_pool = []
+startup_marks.append(("конфигурация", time.perf_counter()))
+
+# Настройки кэша состояний чатов
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "256"))  # Максимум чатов в памяти
+STATE_CACHE_TTL = int(os.getenv("STATE_CACHE_TTL", "3600"))  # Секунд простоя до выгрузки чата
+GAMES_CACHE_SIZE = int(os.getenv("GAMES_CACHE_SIZE", "10000"))  # Максимум списков игр чатов в памяти
+PREFETCH_CHATS = int(os.getenv("PREFETCH_CHATS", "0"))  # Недавно измененных игр, загружаемых при запуске; 0 отключает прогрев
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "4"))  # Параллельных загрузок при прогреве
+PREFETCH_BUDGET = float(os.getenv("PREFETCH_BUDGET", "30"))  # Секунд на прогрев, после которых новые загрузки не начинаются
+
+# Метрики
+class Metrics:
+    """Счетчики вызовов, ошибок и гистограммы времени выполнения.
+
+    Ключ - (вид, имя): обработчики ("handler"), запросы к Google Диску ("drive")
+    и к Bot API ("telegram"). Используется из цикла событий и из потоков
+    Google Диска, поэтому запись идет под блокировкой.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.35, 0.5, 0.75, 1,
+               1.5, 2.5, 5, 10, 30, float("inf"))  # Границы корзин, секунд
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # (вид, имя) -> [вызовы, ошибки, сумма секунд, счетчики корзин]
+        self.started = time.time()
+        self.first_update = None  # Секунд от начала импорта main.py до первого обработанного обновления
+
+    def observe(self, kind, name, seconds, error=False):
+        """Учет одного вызова."""
+        with self._lock:
+            series = self._series.get((kind, name))
+            if series is None:
+                series = self._series[(kind, name)] = [0, 0, 0.0, [0] * len(self.BUCKETS)]
+            series[0] += 1
+            series[1] += error
+            series[2] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series[3][i] += 1
+                    break
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        """Замер блока кода; исключение считается ошибкой и пробрасывается дальше."""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, error)
+
+    def wrap_handler(self, callback):
+        """Обработчик с замером времени."""
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            with self.timer("handler", callback.__name__):
+                return await callback(update, context)
+        return wrapper
+
+    def snapshot(self):
+        """Копия всех рядов, отсортированная по виду и имени."""
+        with self._lock:
+            return sorted((key, [count, errors, total, list(buckets)])
+                          for key, (count, errors, total, buckets) in self._series.items())
+
+    @classmethod
+    def quantile(cls, buckets, q):
+        """Оценка квантиля по гистограмме (линейно внутри корзины)."""
+        count = sum(buckets)
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for bound, in_bucket in zip(cls.BUCKETS, buckets):
+            if in_bucket and seen + in_bucket >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / in_bucket
+            seen += in_bucket
+            if bound != float("inf"):
+                lower = bound
+        return lower
+
+    def prometheus(self, extra=()):
+        """Метрики в текстовом формате Prometheus; extra - тройки (имя, тип, значение)."""
+        lines = []
+        for kind in ("handler", "drive", "telegram"):
+            metric = f"rpr_{kind}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            errors = []
+            for (series_kind, name), (count, error_count, total, buckets) in self.snapshot():
+                if series_kind != kind:
+                    continue
+                cumulative = 0
+                for bound, in_bucket in zip(self.BUCKETS, buckets):
+                    cumulative += in_bucket
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric}_bucket{{name="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {total:.6f}')
+                lines.append(f'{metric}_count{{name="{name}"}} {count}')
+                errors.append(f'rpr_{kind}_errors_total{{name="{name}"}} {error_count}')
+            lines.append(f"# TYPE rpr_{kind}_errors_total counter")
+            lines.extend(errors)
+        for name, metric_type, value in extra:
+            lines.append(f"# TYPE rpr_{name} {metric_type}")
+            lines.append(f"rpr_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+class TimedRequest(HTTPXRequest):
+    """Запросы к Bot API с учетом в метриках (имя - метод API, например sendMessage)."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            error = code >= 400
+            return code, payload
+        finally:
+            metrics.observe("telegram", url.rsplit("/", 1)[-1], time.perf_counter() - start, error)
 
 # Инициализация клиента Google Drive
+DRIVE_CLIENT_MODULES = ("google.oauth2.service_account", "googleapiclient.discovery", "googleapiclient.http",
+                        "google_auth_httplib2", "httplib2")  # Тяжелые модули, которые не нужны до первого обращения к Диску
+
+@functools.lru_cache(maxsize=None)
+def timed_http_request_class():
+    """Класс запроса к Google Drive API с учетом в метриках (имя - метод API, например files.list)."""
+    from googleapiclient.http import HttpRequest
+
+    class TimedHttpRequest(HttpRequest):
+        def execute(self, *args, **kwargs):
+            name = (self.methodId or self.method).removeprefix("drive.")
+            if "alt=media" in self.uri:
+                name += "_media"
+            with metrics.timer("drive", name):
+                return super().execute(*args, **kwargs)
+
+    return TimedHttpRequest
+
+class DriveClientProvider:
+    """Общий на весь процесс клиент Google Drive API.
+
+    Учетные данные (и их токен) и сам клиент создаются один раз. Клиент
+    собирается по встроенному в googleapiclient документу discovery, а
+    HTTP-соединения держатся отдельно для каждого потока, так как httplib2
+    не потокобезопасен.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._credentials = None
+        self._service = None
+        self.builds = 0
+        self.builds_avoided = 0
+
+    def _http(self):
+        """Постоянное HTTP-соединение текущего потока."""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = AuthorizedHttp(self._credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+            self._local.http = http
+        return http
+
+    def _request_builder(self, http, *args, **kwargs):
+        """Запросы всегда идут через соединение вызывающего потока."""
+        return timed_http_request_class()(self._http(), *args, **kwargs)
+
+    def get(self):
+        """Получение клиента; сборка выполняется только при первом вызове."""
+        with self._lock:
+            if self._service is not None:
+                self.builds_avoided += 1
+                return self._service
+            from google.oauth2 import service_account
+            from googleapiclient.discovery import build
+
+            creds_json = json.loads(GOOGLE_CREDENTIALS)
+            self._credentials = service_account.Credentials.from_service_account_info(creds_json, scopes=DRIVE_SCOPES)
+            self._service = build(
+                'drive', 'v3',
+                http=self._http(),
+                requestBuilder=self._request_builder,
+                cache_discovery=False,
+                static_discovery=True,
+            )
+            self.builds += 1
+            logger.info("Клиент Google Drive API создан.")
+            return self._service
+
+
+drive_clients = DriveClientProvider()
+drive_executor = ThreadPoolExecutor(max_workers=DRIVE_WORKERS, thread_name_prefix="drive")
+
 def get_gdrive_service():
     """Получение сервиса Google Drive API."""
     try:
-        creds_json = json.loads(GOOGLE_CREDENTIALS)
-        creds = service_account.Credentials.from_service_account_info(creds_json)
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        return drive_clients.get()
     except Exception as e:
         logger.error(f"Ошибка при инициализации Google Drive API: {e}")
         return None
@@ -44,18 +295,144 @@ def get_filename(chat_id, game_number="default"):
     """Формирование имени файла на Google Диске."""
     return f"answers_chat_{chat_id}_game_{game_number}.json"
 
-def find_file_id(service, filename, parent_folder_id=None):
-    """Поиск файла на Google Диске."""
+def get_segment_filename(chat_id, game_number, segment):
+    """Имя файла сегмента ответов игры на Google Диске."""
+    return f"segment_chat_{chat_id}_game_{game_number}_{segment}.json"
+
+def get_games_filename(chat_id):
+    """Имя файла со списком игр чата на Google Диске."""
+    return f"games_chat_{chat_id}.json"
+
+STATE_FILENAME_RE = re.compile(r"answers_chat_(-?\d+)_game_(.+)\.json")
+
+def load_file_ids():
+    """Загрузка индекса имя файла -> ID файла на Google Диске (локально)"""
+    try:
+        with open(FILE_IDS_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_file_ids():
+    """Сохранение индекса ID файлов (локально)"""
+    with open(FILE_IDS_FILE, "w") as f:
+        json.dump(file_ids, f)
+
+def remember_file_id(filename, file_id):
+    """Запоминание ID файла; ID файла чата не меняется, пока файл существует."""
+    remember_file_ids({filename: file_id})
+
+def remember_file_ids(mapping):
+    """Запоминание ID нескольких файлов с одной перезаписью индекса."""
+    with file_ids_lock:
+        changed = False
+        for filename, file_id in mapping.items():
+            missing_files.pop(filename, None)
+            if file_ids.get(filename) != file_id:
+                file_ids[filename] = file_id
+                changed = True
+        if changed:
+            save_file_ids()
+
+def remember_missing_file(filename):
+    """Файла точно нет на Google Диске (по результату пакетного поиска)."""
+    with file_ids_lock:
+        missing_files[filename] = time.monotonic()
+
+def forget_file_id(filename):
+    """Сброс ID файла из индекса (Google Диск вернул 404)."""
+    with file_ids_lock:
+        if file_ids.pop(filename, None) is not None:
+            save_file_ids()
+            logger.info(f"ID файла {filename} удален из индекса.")
+
+def is_not_found(error):
+    """Проверка, что Google Диск ответил 404."""
+    return getattr(error.resp, "status", None) == 404
+
+def file_query(filename, parent_folder_id=None):
+    """Запрос files.list для поиска файла по имени."""
     query = f"name='{filename}' and trashed=false"
     if parent_folder_id:
         query += f" and '{parent_folder_id}' in parents"
+    return query
+
+def lookup_file_ids(service, filenames, parent_folder_id=None):
+    """Поиск ID нескольких файлов пакетными запросами (batch) вместо запроса на файл.
+
+    Найденные ID попадают в индекс, отсутствующие файлы запоминаются на
+    MISSING_FILE_TTL секунд. Запросы, завершившиеся ошибкой, повторяются
+    следующим пакетом до DRIVE_BATCH_RETRIES раз.
+    """
+    with file_ids_lock:
+        pending = [filename for filename in dict.fromkeys(filenames) if filename not in file_ids]
+    for attempt in range(DRIVE_BATCH_RETRIES + 1):
+        if not pending:
+            return
+        if attempt:
+            time.sleep(min(2 ** attempt * 0.5, 10))
+        failed = []
+        for start in range(0, len(pending), DRIVE_BATCH_SIZE):
+            failed.extend(_lookup_batch(service, pending[start:start + DRIVE_BATCH_SIZE], parent_folder_id))
+        pending = failed
+    if pending:
+        logger.error(f"Не удалось найти на Google Диске файлов: {len(pending)} (после {DRIVE_BATCH_RETRIES} повторов).")
+
+def _lookup_batch(service, filenames, parent_folder_id):
+    """Один пакет поиска файлов; возвращает имена, поиск которых нужно повторить."""
+    responses = {}
+
+    def collect(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=collect)
+    for index, filename in enumerate(filenames):
+        batch.add(service.files().list(q=file_query(filename, parent_folder_id), fields="files(id)"), request_id=str(index))
     try:
-        results = service.files().list(q=query, fields="files(id)").execute()
-        items = results.get('files', [])
-        return items[0]['id'] if items else None
+        with metrics.timer("drive", "batch"):
+            batch.execute()
     except HttpError as error:
-        logger.error(f"Ошибка при поиске файла: {error}")
+        logger.warning(f"Ошибка пакетного запроса к Google Диску ({len(filenames)} файлов): {error}")
+        return list(filenames)
+
+    failed = []
+    found = {}
+    for index, filename in enumerate(filenames):
+        response, exception = responses.get(str(index), (None, None))
+        if exception is not None or response is None:
+            failed.append(filename)
+            continue
+        items = response.get('files', [])
+        if items:
+            found[filename] = items[0]['id']
+        else:
+            remember_missing_file(filename)
+    remember_file_ids(found)
+    found = len(found)
+    logger.info(f"Пакетный поиск на Google Диске: файлов {len(filenames)}, найдено {found}, "
+                f"нет на диске {len(filenames) - found - len(failed)}, ошибок {len(failed)}.")
+    return failed
+
+@metrics.timer("drive", "find_file_id")
+def find_file_id(service, filename, parent_folder_id=None):
+    """Поиск файла на Google Диске (сначала в локальном индексе).
+
+    None - только если файла нет; ошибка запроса (HttpError) пробрасывается,
+    чтобы сбой не приняли за отсутствие файла.
+    """
+    file_id = file_ids.get(filename)
+    if file_id:
+        return file_id
+    checked = missing_files.get(filename)
+    if checked is not None and time.monotonic() - checked < MISSING_FILE_TTL:
+        return None
+
+    results = service.files().list(q=file_query(filename, parent_folder_id), fields="files(id)").execute()
+    items = results.get('files', [])
+    if not items:
         return None
+    remember_file_id(filename, items[0]['id'])
+    return items[0]['id']
 
 def create_empty_json_on_drive(service, filename, parent_folder_id=None):
     """Создает пустой JSON-файл на Google Диске."""
@@ -63,92 +440,1574 @@ def create_empty_json_on_drive(service, filename, parent_folder_id=None):
     if parent_folder_id:
         file_metadata['parents'] = [parent_folder_id]
 
+    from googleapiclient.http import MediaIoBaseUpload
+
     empty_json = io.BytesIO(json.dumps({}).encode('utf-8'))
     media = MediaIoBaseUpload(empty_json, mimetype="application/json")
 
     try:
         file = service.files().create(body=file_metadata, media_body=media).execute()
         logger.info(f"Создан пустой JSON-файл: {filename}, ID: {file['id']}")
+        remember_file_id(filename, file['id'])
         return file['id']
     except HttpError as error:
         logger.error(f"Ошибка при создании файла: {error}")
         return None
 
-def load_bot_state(chat_id, game_number="default"):
-    """Загрузка состояния бота из Google Диска."""
-    global user_answers, answer_list, roll_pool
-    service = get_gdrive_service()
-    if not service:
-        logger.error("Не удалось получить доступ к Google Drive.")
-        return
+class FenwickTree:
+    """Дерево Фенвика: изменение значения и префиксные суммы за O(log n)."""
+
+    def __init__(self, values=()):
+        self._values = list(values)
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _grow(self, size):
+        """Увеличение размера (с запасом) с перестроением за O(n)."""
+        self._values.extend([0] * (max(size, 2 * len(self._values)) - len(self._values)))
+        self._rebuild()
+
+    def _rebuild(self):
+        """Построение дерева по значениям за O(n)."""
+        self._tree = [0] + self._values
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def add(self, index, delta):
+        """Прибавление delta к элементу index."""
+        if index >= len(self._values):
+            self._grow(index + 1)
+        self._values[index] += delta
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def get(self, index):
+        """Значение элемента index."""
+        return self._values[index] if index < len(self._values) else 0
+
+    def prefix_sum(self, end):
+        """Сумма элементов [0, end)."""
+        end = min(end, len(self._values))
+        total = 0
+        while end > 0:
+            total += self._tree[end]
+            end -= end & -end
+        return total
+
+    def total(self):
+        """Сумма всех элементов."""
+        return self.prefix_sum(len(self._values))
+
+    def find(self, value):
+        """Наименьший index, у которого prefix_sum(index + 1) > value."""
+        position = 0
+        step = 1 << len(self._values).bit_length()
+        while step:
+            following = position + step
+            if following < len(self._tree) and self._tree[following] <= value:
+                position = following
+                value -= self._tree[following]
+            step >>= 1
+        return position
+
+
+class Leaderboard:
+    """Рейтинг пользователей, обновляемый при каждом изменении ответов.
+
+    Баллы меняются за O(log n), top-K выдается за O(K log n), место
+    пользователя - за O(log n) без обхода списка ответов.
+    """
+
+    def __init__(self):
+        self._scores = {}  # user_id -> баллы
+        self._buckets = {}  # баллы -> пользователи с этими баллами в порядке их достижения
+        self._counts = FenwickTree()  # баллы -> количество пользователей
+
+    @classmethod
+    def from_user_answers(cls, user_answers):
+        """Построение рейтинга по ответам пользователей."""
+        leaderboard = cls()
+        for user_id, answers in user_answers.items():
+            leaderboard.add(user_id, len(answers))
+        return leaderboard
+
+    def __len__(self):
+        return len(self._scores)
+
+    def score(self, user_id):
+        """Баллы пользователя."""
+        return self._scores.get(user_id, 0)
+
+    def _place(self, user_id, score):
+        self._scores[user_id] = score
+        self._buckets.setdefault(score, {})[user_id] = None
+        self._counts.add(score, 1)
+
+    def _unplace(self, user_id):
+        score = self._scores.pop(user_id)
+        bucket = self._buckets[score]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[score]
+        self._counts.add(score, -1)
+        return score
+
+    def add(self, user_id, delta=1):
+        """Изменение баллов пользователя; пользователь с 0 баллов выбывает."""
+        score = self._unplace(user_id) if user_id in self._scores else 0
+        if score + delta > 0:
+            self._place(user_id, score + delta)
+
+    def items(self):
+        """Пары (user_id, баллы); порядок сохраняет очередность при равных баллах."""
+        return list(self._scores.items())
+
+    def remove_user(self, user_id):
+        """Удаление пользователя из рейтинга."""
+        if user_id in self._scores:
+            self._unplace(user_id)
+
+    def clear(self):
+        """Очистка рейтинга."""
+        self.__init__()
+
+    def rank(self, user_id):
+        """Место пользователя (1 - лучший) или None, если его нет в рейтинге."""
+        if user_id not in self._scores:
+            return None
+        return len(self._scores) - self._counts.prefix_sum(self._scores[user_id] + 1) + 1
+
+    def top(self, k=None):
+        """Первые k пользователей рейтинга: список пар (user_id, баллы)."""
+        total = len(self._scores)
+        k = total if k is None else min(k, total)
+        result = []
+        while len(result) < k:
+            # Баллы пользователя на позиции len(result) по убыванию
+            score = self._counts.find(total - 1 - len(result))
+            for user_id in self._buckets[score]:
+                result.append((user_id, score))
+        return result[:k]
+
+
+class WeightedSet:
+    """Множество с весами: добавление, удаление и равновероятный выбор элемента за O(1).
+
+    Если у каких-то элементов есть вес, отличный от 1, строится дерево Фенвика
+    по позициям, и выбор пропорционально весам идет за O(log n).
+    """
+
+    def __init__(self, numbers=()):
+        self._numbers = []
+        self._positions = {}  # номер -> позиция в _numbers
+        self._weights = {}  # номер -> вес (хранятся только веса, отличные от 1)
+        self._tree = None  # FenwickTree весов по позициям; None, пока все веса равны 1
+        for number in numbers:
+            self.add(number)
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __contains__(self, number):
+        return number in self._positions
+
+    def __iter__(self):
+        return iter(self._numbers)
+
+    def weight(self, number):
+        """Вес элемента."""
+        return self._weights.get(number, 1)
+
+    def total(self):
+        """Сумма весов за O(log n)."""
+        if self._tree is None:
+            return len(self._numbers)
+        return self._tree.prefix_sum(len(self._numbers))
+
+    def _build_tree(self):
+        self._tree = FenwickTree(self.weight(number) for number in self._numbers)
+
+    def add(self, number, weight=1):
+        """Добавление номера ответа в пул."""
+        if number in self._positions:
+            self.set_weight(number, weight)
+            return
+        self._positions[number] = len(self._numbers)
+        self._numbers.append(number)
+        if weight != 1:
+            self._weights[number] = weight
+        if self._tree is not None:
+            self._tree.add(self._positions[number], weight)
+        elif weight != 1:
+            self._build_tree()
+
+    def set_weight(self, number, weight):
+        """Изменение веса номера."""
+        if number not in self._positions:
+            return
+        old_weight = self.weight(number)
+        if weight == 1:
+            self._weights.pop(number, None)
+        else:
+            self._weights[number] = weight
+        if self._tree is not None:
+            self._tree.add(self._positions[number], weight - old_weight)
+        elif weight != 1:
+            self._build_tree()
+
+    def discard(self, number):
+        """Удаление номера из пула (последний элемент переносится на его место)."""
+        position = self._positions.pop(number, None)
+        if position is None:
+            return False
+        weight = self._weights.pop(number, 1)
+        last = self._numbers.pop()
+        if position < len(self._numbers):
+            self._numbers[position] = last
+            self._positions[last] = position
+            if self._tree is not None:
+                self._tree.add(position, self.weight(last) - weight)
+                self._tree.add(len(self._numbers), -self.weight(last))
+        elif self._tree is not None:
+            self._tree.add(position, -weight)
+        return True
+
+    def choice(self):
+        """Выбор номера с вероятностью, пропорциональной весу; None, если выбирать не из чего."""
+        if not self._numbers:
+            return None
+        if self._tree is None:
+            return random.choice(self._numbers)
+        total = self._tree.prefix_sum(len(self._numbers))
+        if total <= 0:
+            return None
+        position = self._tree.find(random.random() * total)
+        return self._numbers[min(position, len(self._numbers) - 1)]
+
+    def clear(self):
+        """Очистка множества."""
+        self._numbers.clear()
+        self._positions.clear()
+        self._weights.clear()
+        self._tree = None
+
+
+class RollPool:
+    """Пул розыгрыша: номера ответов, сгруппированные по авторам.
+
+    Выбор идет в два шага: автор - пропорционально сумме весов его ответов в
+    пуле, затем ответ автора - пропорционально его весу; итоговая вероятность
+    ответа та же, что при выборе из общего пула. Розыгрыш нескольких
+    победителей исключает уже выигравших авторов обнулением их веса на
+    верхнем уровне, поэтому стоит O(log n) на победителя независимо от того,
+    сколько ответов у автора.
+    """
+
+    def __init__(self):
+        self._groups = {}  # автор -> WeightedSet его номеров
+        self._owners = {}  # номер -> автор
+        self._authors = WeightedSet()  # авторы с весом - суммой весов их номеров
+
+    def __len__(self):
+        return len(self._owners)
+
+    def __contains__(self, number):
+        return number in self._owners
+
+    def __iter__(self):
+        return iter(self._owners)
+
+    @staticmethod
+    def _group_key(number, group):
+        # Ответы без автора не связаны друг с другом: каждый - отдельная группа
+        return group if group is not None else ("answer", number)
+
+    def _update_author(self, group):
+        numbers = self._groups[group]
+        if numbers:
+            self._authors.add(group, numbers.total())
+        else:
+            del self._groups[group]
+            self._authors.discard(group)
+
+    def weight(self, number):
+        """Вес номера в пуле."""
+        group = self._owners.get(number)
+        return self._groups[group].weight(number) if group is not None else 1
+
+    def add(self, number, weight=1, group=None):
+        """Добавление номера ответа автора group в пул."""
+        if number in self._owners:
+            self.set_weight(number, weight)
+            return
+        group = self._group_key(number, group)
+        self._owners[number] = group
+        self._groups.setdefault(group, WeightedSet()).add(number, weight)
+        self._update_author(group)
+
+    def set_weight(self, number, weight):
+        """Изменение веса номера."""
+        group = self._owners.get(number)
+        if group is None:
+            return
+        self._groups[group].set_weight(number, weight)
+        self._update_author(group)
+
+    def discard(self, number):
+        """Удаление номера из пула."""
+        group = self._owners.pop(number, None)
+        if group is None:
+            return False
+        self._groups[group].discard(number)
+        self._update_author(group)
+        return True
+
+    def choice(self):
+        """Выбор номера с вероятностью, пропорциональной весу; None, если выбирать не из чего."""
+        group = self._authors.choice()
+        return self._groups[group].choice() if group is not None else None
+
+    def draw(self, count=1):
+        """До count номеров разных авторов; пул после розыгрыша остается прежним."""
+        if count == 1:
+            number = self.choice()
+            return [number] if number is not None else []
+        numbers = []
+        drawn = []  # (автор, вес) временно обнуленных авторов
+        while len(numbers) < count:
+            group = self._authors.choice()
+            if group is None:
+                break
+            number = self._groups[group].choice()
+            if number is None:
+                break
+            numbers.append(number)
+            drawn.append((group, self._authors.weight(group)))
+            self._authors.set_weight(group, 0)
+        for group, weight in drawn:
+            self._authors.set_weight(group, weight)
+        return numbers
+
+    def clear(self):
+        """Очистка пула."""
+        self._groups.clear()
+        self._owners.clear()
+        self._authors.clear()
+
+
+def _user_id(key):
+    """user_id из ключа JSON (в файлах версии 1 ключи - строки)."""
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        return key
+
+def migrate_state_v1(state):
+    """Перевод состояния из схемы версии 1 (answer_list + user_answers) в версию 2.
+
+    Версия 1 нумеровала ответы как len(answer_list) + 1, поэтому после /minus
+    номера повторялись; повторы получают новые номера после максимального.
+    """
+    # Авторы ответов (ключи user_answers в версии 1 - строки); одинаковых (номер, текст) может быть несколько
+    authors = {}
+    for key, user_answers in state.get("user_answers", {}).items():
+        for answer in user_answers:
+            authors.setdefault((answer["number"], answer["text"]), []).append(_user_id(key))
+    # Ответы исключенных пользователей остались только в answer_list
+    entries = []  # [старый номер, user_id автора, текст]
+    for answer in state.get("answer_list", []):
+        owners = authors.get((answer["number"], answer["text"]))
+        entries.append([answer["number"], owners.pop(0) if owners else None, answer["text"]])
+    for (number, text), owners in authors.items():
+        entries.extend([number, user_id, text] for user_id in owners)
+
+    next_number = max((number for number, _, _ in entries), default=0) + 1
+    seen = set()
+    answers = []
+    for original, user_id, text in entries:
+        number = original
+        if number in seen:
+            number, next_number = next_number, next_number + 1
+        seen.add(number)
+        answers.append((original, [number, user_id, text]))
+
+    # Повтор номера в roll_pool относится к повторному ответу; сначала к засчитанным автору,
+    # потому что исключение пользователя убирало из roll_pool ответы без автора
+    in_pool = {}
+    for number in state.get("roll_pool", []):
+        in_pool[number] = in_pool.get(number, 0) + 1
+    roll_pool = []
+    for owned in (True, False):
+        for original, (number, user_id, _) in answers:
+            if (user_id is not None) == owned and in_pool.get(original):
+                in_pool[original] -= 1
+                roll_pool.append(number)
+
+    migrated = dict(state)
+    for key in ("user_answers", "answer_list"):
+        migrated.pop(key, None)
+    migrated.update({
+        "version": STATE_VERSION,
+        "answers": sorted(answer for _, answer in answers),
+        "roll_pool": sorted(roll_pool),
+        "next_number": next_number,
+    })
+    return migrated
+
+
+class ChatState:
+    """Состояние одной игры в чате.
+
+    Ответы хранятся в индексе номер -> ответ, для каждого номера известен
+    автор, поэтому поиск, удаление и розыгрыш не обходят списки ответов.
+    """
+
+    def __init__(self, chat_id, game_number="default"):
+        self.chat_id = chat_id
+        self.game_number = game_number
+        self.answers = {}  # номер -> ответ, в порядке добавления
+        self.owners = {}  # номер -> user_id автора (None, если ответ уже не засчитан автору)
+        self.user_answers = {}  # user_id -> {номер: ответ}
+        self.next_number = 1
+        self.user_weights = {}  # user_id -> вес всех ответов пользователя
+        self.answer_weights = {}  # номер -> вес отдельного ответа
+        self.exclude_winners = False  # Победители сами выбывают из следующих розыгрышей
+        self.roll_pool = RollPool()
+        self.live_leaderboard = LIVE_LEADERBOARD  # Таблица лидеров обновляется редактированием одного сообщения
+        self.leaderboard_message_ids = []
+        self.leaderboard = Leaderboard()
+        self.members = {}  # user_id -> (логин или None, полное имя) всех, кого бот видел в чате
+        self.usernames = {}  # логин в нижнем регистре -> user_id
+        self.segments = set()  # Номера сегментов, в которых есть или были ответы
+        self.segment_sizes = {}  # Номер сегмента -> ответов в нем на момент последнего сохранения
+        self.missing_segments = set()  # Сегменты, еще не загруженные из хранилища
+        self.dirty_segments = set()  # Сегменты, измененные после последнего сохранения
+        self.segments_lock = asyncio.Lock()
+        self.pending_ops = []  # Операции, еще не переданные в хранилище
+        self.revision = 0  # Номер последней операции (seq в журнале)
+        self.saved_revision = 0  # Номер операции, вошедшей в последний снимок на Google Диске
+        self.save_lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+
+    @classmethod
+    def from_dict(cls, chat_id, game_number, state):
+        """Создание состояния из загруженного JSON (файлы версии 1 обновляются на лету)."""
+        if state.get("version", 1) == MANIFEST_VERSION:
+            return cls.from_manifest(chat_id, game_number, state)
+        if state.get("version", 1) < STATE_VERSION:
+            state = migrate_state_v1(state)
+        chat_state = cls(chat_id, game_number)
+        for number, user_id, text in state.get("answers", []):
+            answer_data = {"number": number, "text": text}
+            chat_state.answers[number] = answer_data
+            chat_state.owners[number] = user_id
+            if user_id is not None:
+                chat_state.user_answers.setdefault(user_id, {})[number] = answer_data
+        chat_state.next_number = max(state.get("next_number", 1), max(chat_state.answers, default=0) + 1)
+        chat_state.user_weights = dict(state.get("user_weights", []))
+        chat_state.answer_weights = dict(state.get("answer_weights", []))
+        chat_state.exclude_winners = state.get("exclude_winners", False)
+        for number in state.get("roll_pool", []):
+            chat_state.roll_pool.add(number, chat_state.answer_weight(number), chat_state.owners.get(number))
+        chat_state.live_leaderboard = state.get("live_leaderboard", LIVE_LEADERBOARD)
+        chat_state.leaderboard_message_ids = state.get("leaderboard_message_ids", [])
+        chat_state.leaderboard = Leaderboard.from_user_answers(chat_state.user_answers)
+        for user_id, username, name in state.get("members", []):
+            chat_state.remember_member(user_id, username, name)
+        chat_state.revision = chat_state.saved_revision = state.get("seq", 0)
+        # При сохранении сегментами все ответы старого файла записываются заново
+        chat_state.segments = {chat_state.segment_of(number) for number in chat_state.answers}
+        chat_state.dirty_segments = set(chat_state.segments)
+        return chat_state
+
+    @classmethod
+    def from_manifest(cls, chat_id, game_number, manifest):
+        """Создание состояния по манифесту; сами ответы подгружаются по сегментам (ensure_answers)."""
+        chat_state = cls(chat_id, game_number)
+        chat_state.next_number = manifest.get("next_number", 1)
+        chat_state.user_weights = dict(manifest.get("user_weights", []))
+        chat_state.exclude_winners = manifest.get("exclude_winners", False)
+        chat_state.live_leaderboard = manifest.get("live_leaderboard", LIVE_LEADERBOARD)
+        chat_state.leaderboard_message_ids = manifest.get("leaderboard_message_ids", [])
+        for user_id, username, name in manifest.get("members", []):
+            chat_state.remember_member(user_id, username, name)
+        for user_id, score in manifest.get("scores", []):
+            chat_state.leaderboard.add(user_id, score)
+        chat_state.segment_sizes = dict(manifest.get("segments", []))
+        chat_state.segments = set(chat_state.segment_sizes)
+        chat_state.missing_segments = set(chat_state.segments)
+        chat_state.revision = chat_state.saved_revision = manifest.get("seq", 0)
+        return chat_state
+
+    @staticmethod
+    def segment_of(number):
+        """Номер сегмента, в котором хранится ответ."""
+        return (number - 1) // ANSWER_SEGMENT_SIZE
+
+    def manifest(self):
+        """Манифест игры: все, кроме самих ответов (они в сегментах)."""
+        manifest = self.meta()
+        manifest.update({
+            "version": MANIFEST_VERSION,
+            "segment_size": ANSWER_SEGMENT_SIZE,
+            "segments": [[segment, self.segment_sizes.get(segment, 0)] for segment in sorted(self.segments)],
+            "scores": self.leaderboard.items(),
+            "user_weights": list(self.user_weights.items()),
+        })
+        return manifest
+
+    def segment_rows(self, segment):
+        """Ответы сегмента: [номер, user_id автора, текст, вес ответа, в розыгрыше]."""
+        rows = []
+        first = segment * ANSWER_SEGMENT_SIZE + 1
+        for number in range(first, first + ANSWER_SEGMENT_SIZE):
+            answer = self.answers.get(number)
+            if answer is None:
+                continue
+            user_id = self.owners.get(number)
+            if number not in self.user_answers.get(user_id, {}):
+                user_id = None
+            rows.append([number, user_id, answer["text"], self.answer_weights.get(number, 1), int(number in self.roll_pool)])
+        return rows
+
+    def take_dirty_segments(self):
+        """Измененные сегменты для сохранения; после неудачи их нужно вернуть в dirty_segments."""
+        segments = {segment: self.segment_rows(segment) for segment in self.dirty_segments}
+        self.dirty_segments.clear()
+        for segment, rows in segments.items():
+            self.segment_sizes[segment] = len(rows)
+        return segments
+
+    @property
+    def answer_count(self):
+        """Число ответов игры, включая еще не загруженные сегменты."""
+        return len(self.answers) + sum(self.segment_sizes.get(segment, 0) for segment in self.missing_segments)
+
+    def merge_segment(self, segment, rows):
+        """Добавление загруженного сегмента к ответам в памяти."""
+        for number, user_id, text, weight, in_pool in rows:
+            if number in self.answers:
+                continue
+            answer_data = {"number": number, "text": text}
+            self.answers[number] = answer_data
+            self.owners[number] = user_id
+            if user_id is not None:
+                self.user_answers.setdefault(user_id, {})[number] = answer_data
+            if weight != 1:
+                self.answer_weights[number] = weight
+            if in_pool:
+                self.roll_pool.add(number, self.answer_weight(number), user_id)
+        self.missing_segments.discard(segment)
+        if not self.missing_segments:
+            # Сегменты приходят в произвольном порядке, а список ответов выводится по номерам
+            self.answers = dict(sorted(self.answers.items()))
+
+    def _touched_segments(self, op):
+        """Сегменты, которые изменит операция."""
+        kind = op["op"]
+        if kind in ("add", "remove", "answer_weight"):
+            return {self.segment_of(op.get("number") or self.next_number)}
+        if kind == "discard":
+            return {self.segment_of(number) for number in op["numbers"]}
+        if kind == "exclude":
+            return {self.segment_of(number) for number in self.user_answers.get(op["user"], ())}
+        if kind == "clear":
+            return set(self.segments)
+        return set()
+
+    def to_dict(self):
+        """Представление состояния для сохранения в JSON (схема версии 2).
+
+        Каждый ответ хранится один раз как [номер, user_id автора, текст];
+        словари с целочисленными ключами хранятся списками пар.
+        """
+        answers = []
+        for number, answer in self.answers.items():
+            user_id = self.owners.get(number)
+            if number not in self.user_answers.get(user_id, {}):
+                user_id = None
+            answers.append([number, user_id, answer["text"]])
+        state = self.meta()
+        state.update({
+            "answers": answers,
+            "roll_pool": list(self.roll_pool),
+            "user_weights": list(self.user_weights.items()),
+            "answer_weights": list(self.answer_weights.items()),
+        })
+        return state
+
+    def meta(self):
+        """Поля состояния, не относящиеся к ответам (для хранилищ, пишущих ответы построчно)."""
+        return {
+            "version": STATE_VERSION,
+            "seq": self.revision,
+            "next_number": self.next_number,
+            "exclude_winners": self.exclude_winners,
+            "live_leaderboard": self.live_leaderboard,
+            "leaderboard_message_ids": self.leaderboard_message_ids,
+            "members": self.member_rows(),
+        }
+
+    @property
+    def dirty(self):
+        """Есть изменения, еще не сохраненные в хранилище."""
+        return self.revision != self.saved_revision
+
+    def apply(self, op):
+        """Применение операции (из обработчика или из журнала); False, если ничего не изменилось."""
+        kind = op["op"]
+        touched = self._touched_segments(op)
+        # Исключению нужны все ответы пользователя, остальным операциям - только их сегменты
+        required = self.segments if kind == "exclude" else touched if kind != "clear" else set()
+        if required & self.missing_segments:
+            raise RuntimeError(f"Ответы игры {self.game_number} чата {self.chat_id} загружены не полностью")
+        if kind == "add":
+            self.add_answer(op["user"], op["text"], op.get("number"))
+        elif kind == "remove":
+            if not self.remove_answer(op["number"]):
+                return False
+        elif kind == "exclude":
+            if not self.exclude_user(op["user"]):
+                return False
+        elif kind == "clear":
+            self.clear()
+            self.missing_segments.clear()
+        elif kind == "user_weight":
+            self.set_user_weight(op["user"], op["weight"])
+        elif kind == "answer_weight":
+            if not self.set_answer_weight(op["number"], op["weight"]):
+                return False
+        elif kind == "discard":
+            for number in op["numbers"]:
+                self.roll_pool.discard(number)
+        elif kind == "members":
+            for user_id, username, name in op["members"]:
+                self.remember_member(user_id, username, name)
+        elif kind == "set":
+            for field, value in op["values"].items():
+                if field not in ("exclude_winners", "live_leaderboard", "leaderboard_message_ids"):
+                    raise ValueError(f"Неизвестное поле состояния: {field}")
+                setattr(self, field, value)
+        else:
+            raise ValueError(f"Неизвестная операция: {kind}")
+        self.segments |= touched
+        self.dirty_segments |= touched
+        self.pending_ops.append(op)
+        self.revision += 1
+        return True
+
+    def add_answer(self, user_id, text, number=None):
+        """Добавление ответа пользователя; возвращает данные ответа."""
+        answer_data = {"number": number or self.next_number, "text": text}
+        self.next_number = max(self.next_number, answer_data["number"]) + 1
+        self.answers[answer_data["number"]] = answer_data
+        self.owners[answer_data["number"]] = user_id
+        self.user_answers.setdefault(user_id, {})[answer_data["number"]] = answer_data
+        self.roll_pool.add(answer_data["number"], self.answer_weight(answer_data["number"]), user_id)
+        self.leaderboard.add(user_id)
+        return answer_data
+
+    def remove_answer(self, number):
+        """Удаление ответа по номеру; False, если такого ответа нет."""
+        if self.answers.pop(number, None) is None:
+            return False
+        self.roll_pool.discard(number)
+        self.answer_weights.pop(number, None)
+        user_id = self.owners.pop(number, None)
+        user_answers = self.user_answers.get(user_id)
+        if user_answers is not None and user_answers.pop(number, None) is not None:
+            self.leaderboard.add(user_id, -1)
+            if not user_answers:
+                del self.user_answers[user_id]
+        return True
+
+    def exclude_user(self, user_id):
+        """Исключение пользователя из розыгрыша; False, если у него нет ответов."""
+        if user_id not in self.user_answers:
+            return False
+        # Удаляем все ответы пользователя из roll_pool
+        for number in self.user_answers.pop(user_id):
+            self.roll_pool.discard(number)
+        self.leaderboard.remove_user(user_id)
+        return True
+
+    def clear(self):
+        """Очистка всех ответов игры."""
+        self.answers.clear()
+        self.owners.clear()
+        self.user_answers.clear()
+        self.roll_pool.clear()
+        self.leaderboard.clear()
+        self.answer_weights.clear()
+        self.next_number = 1
+
+    def remember_member(self, user_id, username, name):
+        """Запись участника в справочник чата (логин -> user_id)."""
+        previous = self.members.get(user_id)
+        if previous is not None and previous[0] and self.usernames.get(previous[0].lower()) == user_id:
+            del self.usernames[previous[0].lower()]
+        self.members[user_id] = (username, name)
+        if username:
+            self.usernames[username.lower()] = user_id
+
+    def member_rows(self):
+        """Справочник участников для сохранения: [user_id, логин, полное имя]."""
+        return [[user_id, username, name] for user_id, (username, name) in self.members.items()]
+
+    def find_member(self, username):
+        """user_id участника по логину (с @ или без) или None, если бот его не видел."""
+        return self.usernames.get(username.removeprefix("@").lower())
+
+    def answer_weight(self, number):
+        """Вес ответа в розыгрыше: вес ответа, умноженный на вес его автора."""
+        return self.answer_weights.get(number, 1) * self.user_weights.get(self.owners.get(number), 1)
+
+    def set_user_weight(self, user_id, weight):
+        """Вес всех ответов пользователя в розыгрыше."""
+        if weight == 1:
+            self.user_weights.pop(user_id, None)
+        else:
+            self.user_weights[user_id] = weight
+        for number in self.user_answers.get(user_id, {}):
+            self.roll_pool.set_weight(number, self.answer_weight(number))
+
+    def set_answer_weight(self, number, weight):
+        """Вес отдельного ответа в розыгрыше; False, если такого ответа нет."""
+        if number not in self.answers:
+            return False
+        if weight == 1:
+            self.answer_weights.pop(number, None)
+        else:
+            self.answer_weights[number] = weight
+        self.roll_pool.set_weight(number, self.answer_weight(number))
+        return True
+
+    def draw(self, count=1):
+        """Розыгрыш до count победителей без повторов: список пар (номер ответа, user_id).
+
+        Каждый пользователь выигрывает не более одного раза за розыгрыш; пул
+        после розыгрыша остается прежним.
+        """
+        if self.missing_segments:
+            raise RuntimeError(f"Ответы игры {self.game_number} чата {self.chat_id} загружены не полностью")
+        return [(number, self.owners.get(number)) for number in self.roll_pool.draw(count)]
+
+    def winner_numbers(self, winners):
+        """Номера в пуле, которые выбывают вместе с победителями (все их ответы)."""
+        numbers = set()
+        for number, user_id in winners:
+            numbers.add(number)
+            numbers.update(self.user_answers.get(user_id, {}))
+        return [number for number in numbers if number in self.roll_pool]
+
+
+class ChatStateCache:
+    """Ограниченный LRU-кэш состояний чатов, ключ - (chat_id, game_number)."""
+
+    def __init__(self, max_size=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._loading = {}  # Загрузки, которые уже выполняются
+        self._evicting = {}  # Выгружаемые состояния, которые еще сохраняются
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id, game_number="default"):
+        """Состояние чата из памяти; Google Диск используется только при промахе."""
+        key = (chat_id, game_number)
+        state = self._states.get(key) or self._evicting.get(key)
+        if state is not None:
+            self.hits += 1
+            self._states[key] = state
+            self._states.move_to_end(key)
+        else:
+            self.misses += 1
+            loading = self._loading.get(key) or self._start_loading(key)
+            state = await loading
+            self._states[key] = state
+            self._states.move_to_end(key)
+        state.last_access = time.monotonic()
+        await self.evict()
+        return state
+
+    def peek(self, chat_id, game_number):
+        """Состояние, если оно уже в памяти, без загрузки и без учета в попаданиях."""
+        key = (chat_id, game_number)
+        return self._states.get(key) or self._evicting.get(key)
+
+    def _start_loading(self, key):
+        loading = asyncio.ensure_future(self._load(key))
+        self._loading[key] = loading
+        return loading
+
+    async def _load(self, key):
+        try:
+            state = await run_in_drive_executor(load_bot_state, *key)
+        finally:
+            self._loading.pop(key, None)
+        state.last_access = time.monotonic()
+        self._states[key] = state
+        if state.dirty:
+            # Операции из журнала еще не попали в снимок
+            state_flusher.schedule(state)
+        return state
+
+    async def prefetch(self, chat_id, game_number):
+        """Загрузка состояния заранее, без учета в попаданиях и промахах; True, если состояние загружено.
+
+        Загрузка не прерывается при отмене прогрева: ее результат может уже
+        ждать команда из этого чата.
+        """
+        key = (chat_id, game_number)
+        if key in self._states or key in self._loading or len(self._states) >= self.max_size:
+            return False
+        await asyncio.shield(self._start_loading(key))
+        return True
+
+    async def evict(self):
+        """Выгрузка простаивающих и лишних чатов с сохранением несохраненных изменений."""
+        now = time.monotonic()
+        while self._states:
+            key, state = next(iter(self._states.items()))
+            if len(self._states) <= self.max_size and now - state.last_access < self.ttl:
+                break
+            del self._states[key]
+            if not await self._write_back(key, state):
+                # Остальные чаты выгрузятся при следующем вызове, когда хранилище снова ответит
+                break
+            logger.info(f"Состояние чата {key[0]} (игра {key[1]}) выгружено из памяти.")
+
+    async def unload(self, chat_id, game_number):
+        """Выгрузка одной игры с сохранением; возвращает выгруженное состояние или None.
+
+        Если сохранить не удалось, состояние остается в памяти.
+        """
+        key = (chat_id, game_number)
+        state = self._states.pop(key, None)
+        if state is not None:
+            await self._write_back(key, state)
+        return state
+
+    async def _write_back(self, key, state):
+        """Сохранение выгружаемого состояния; при ошибке оно возвращается в кэш. True, если выгрузка удалась."""
+        if not state.dirty:
+            return True
+        self._evicting[key] = state
+        try:
+            saved = await save_bot_state(state)
+        finally:
+            if self._evicting.get(key) is state:
+                del self._evicting[key]
+        if not saved:
+            # Без журнала несохраненные изменения есть только в памяти
+            logger.warning(f"Не удалось сохранить чат {key[0]} (игра {key[1]}), состояние остается в памяти.")
+            state.last_access = time.monotonic()
+            self._states[key] = state
+            self._states.move_to_end(key)
+        return saved
 
-    filename = get_filename(chat_id, game_number)
-    file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+    async def flush(self):
+        """Сохранение всех несохраненных состояний."""
+        await save_states(list(self._states.values()))
 
-    if not file_id:
-        logger.info(f"Файл {filename} не найден. Создаем пустой JSON...")
-        file_id = create_empty_json_on_drive(service, filename, BASE_FOLDER_ID)
+    def __len__(self):
+        return len(self._states)
 
-    if file_id:
+
+async def run_in_drive_executor(func, *args):
+    """Выполнение блокирующего вызова Google Drive в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(drive_executor, functools.partial(func, *args))
+
+class StateStore:
+    """Хранилище состояний игр; ключ - (chat_id, game_number).
+
+    Все методы блокирующие и вызываются из пула потоков.
+    """
+
+    incremental = False  # Хранилище умеет применять отдельные операции вместо полного снимка
+    segmented = False  # Хранилище пишет манифест и измененные сегменты ответов вместо полного снимка
+
+    def load(self, chat_id, game_number):
+        """Состояние игры (dict), {} для новой игры или None при ошибке."""
+        raise NotImplementedError
+
+    def save(self, chat_id, game_number, snapshot, ops, segments=None):
+        """Сохранение игры; True при успехе.
+
+        snapshot - полный снимок (to_dict), meta() для incremental-хранилищ или
+        manifest() для segmented; ops - операции после прошлого сохранения;
+        segments - измененные сегменты {номер: строки} для segmented.
+        """
+        raise NotImplementedError
+
+    def load_segment(self, chat_id, game_number, segment):
+        """Строки сегмента ответов ([] если его нет) или None при ошибке."""
+        raise NotImplementedError
+
+    def prepare_saves(self, saves):
+        """Подготовка к нескольким сохранениям сразу; saves - тройки (chat_id, game_number, сегменты)."""
+
+    def list(self):
+        """Все сохраненные игры: список пар (chat_id, game_number)."""
+        raise NotImplementedError
+
+    def list_recent(self, limit):
+        """До limit сохраненных игр, сначала недавно измененные (если хранилище это знает)."""
+        return self.list()[:limit]
+
+    def prepare_loads(self, chat_ids):
+        """Подготовка к загрузке списков игр нескольких чатов сразу."""
+
+    def delete(self, chat_id, game_number):
+        """Удаление игры; True при успехе. Бот игры не удаляет (архив хранит их), на Google Диске не реализовано."""
+        raise NotImplementedError
+
+    def load_games(self, chat_id):
+        """Список игр чата (dict), {} если его еще нет, None при ошибке."""
+        raise NotImplementedError
+
+    def save_games(self, chat_id, games):
+        """Сохранение списка игр чата; True при успехе."""
+        raise NotImplementedError
+
+
+class DriveStateStore(StateStore):
+    """Хранение состояний JSON-файлами на Google Диске.
+
+    Файл игры - небольшой манифест (настройки, баллы, список сегментов), ответы
+    лежат в сегментах по ANSWER_SEGMENT_SIZE штук. При изменении загружаются
+    только манифест и измененные сегменты.
+    """
+
+    segmented = True
+
+    def load(self, chat_id, game_number):
+        service = get_gdrive_service()
+        if not service:
+            logger.error("Не удалось получить доступ к Google Drive.")
+            return None
+
+        filename = get_filename(chat_id, game_number)
         try:
+            file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+            if not file_id:
+                logger.info(f"Файл {filename} не найден. Создаем пустой JSON...")
+                file_id = create_empty_json_on_drive(service, filename, BASE_FOLDER_ID)
+            if not file_id:
+                logger.error(f"Не удалось создать файл {filename} на Google Диске.")
+                return None
             request = service.files().get_media(fileId=file_id)
-            file_content = request.execute()
-            state = json.loads(file_content.decode('utf-8'))
-            user_answers = state.get("user_answers", {})
-            answer_list = state.get("answer_list", [])
-            roll_pool = state.get("roll_pool", [])
+            try:
+                file_content = request.execute()
+            except HttpError as error:
+                if not is_not_found(error):
+                    raise
+                # Файл удален с Google Диска: сбрасываем индекс и создаем файл заново
+                forget_file_id(filename)
+                file_id = find_file_id(service, filename, BASE_FOLDER_ID) or create_empty_json_on_drive(service, filename, BASE_FOLDER_ID)
+                if not file_id:
+                    logger.error(f"Не удалось создать файл {filename} на Google Диске.")
+                    return None
+                file_content = service.files().get_media(fileId=file_id).execute()
             logger.info(f"Состояние бота загружено из Google Диска (ID: {file_id}).")
-            logger.info(f"Состояние user_answers после загрузки: {user_answers}")
-            logger.info(f"Состояние answer_list после загрузки: {answer_list}")
-            logger.info(f"Состояние roll_pool после загрузки: {roll_pool}")
+            return json.loads(file_content.decode('utf-8'))
         except HttpError as error:
             logger.error(f"Ошибка загрузки файла с Google Диска: {error}")
-            user_answers, answer_list, roll_pool = {}, [], []
         except json.JSONDecodeError:
             logger.error(f"Файл {filename} содержит некорректный JSON.")
-            user_answers, answer_list, roll_pool = {}, [], []
-    else:
-        logger.error(f"Не удалось создать файл {filename} на Google Диске.")
-        user_answers, answer_list, roll_pool = {}, [], []
+        return None
 
-def save_bot_state(chat_id, game_number="default"):
-    """Сохранение состояния бота на Google Диск."""
-    service = get_gdrive_service()
-    if not service:
-        logger.error("Не удалось получить доступ к Google Drive.")
-        return
+    def save(self, chat_id, game_number, snapshot, ops, segments=None):
+        # Сначала сегменты: манифест не должен ссылаться на еще не записанные ответы
+        for segment, rows in sorted((segments or {}).items()):
+            if not self._upload(get_segment_filename(chat_id, game_number, segment), rows):
+                return False
+        return self._upload(get_filename(chat_id, game_number), snapshot)
+
+    def prepare_saves(self, saves):
+        # ID файлов, которых нет в индексе, ищутся пакетом, а не запросом на каждый файл
+        filenames = []
+        for chat_id, game_number, segments in saves:
+            filenames.append(get_filename(chat_id, game_number))
+            filenames.extend(get_segment_filename(chat_id, game_number, segment) for segment in segments)
+        with file_ids_lock:
+            unknown = [filename for filename in filenames if filename not in file_ids]
+        if len(unknown) < 2:
+            return
+        service = get_gdrive_service()
+        if service:
+            lookup_file_ids(service, unknown, BASE_FOLDER_ID)
+
+    def load_segment(self, chat_id, game_number, segment):
+        service = get_gdrive_service()
+        if not service:
+            logger.error("Не удалось получить доступ к Google Drive.")
+            return None
+        filename = get_segment_filename(chat_id, game_number, segment)
+        try:
+            file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+            if not file_id:
+                return []
+            return json.loads(service.files().get_media(fileId=file_id).execute().decode('utf-8'))
+        except HttpError as error:
+            if is_not_found(error):
+                forget_file_id(filename)
+                return []
+            logger.error(f"Ошибка загрузки сегмента {filename} с Google Диска: {error}")
+        except json.JSONDecodeError:
+            logger.error(f"Файл {filename} содержит некорректный JSON.")
+        return None
 
-    filename = get_filename(chat_id, game_number)
-    file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+    def _upload(self, filename, data):
+        """Запись JSON в файл на Google Диске (файл создается при отсутствии)."""
+        service = get_gdrive_service()
+        if not service:
+            logger.error("Не удалось получить доступ к Google Drive.")
+            return False
 
-    state = {
-        "user_answers": user_answers,
-        "answer_list": answer_list,
-        "roll_pool": roll_pool
-    }
-    json_data = io.BytesIO(json.dumps(state, ensure_ascii=False, indent=4).encode('utf-8'))
-    media = MediaIoBaseUpload(json_data, mimetype="application/json")
+        from googleapiclient.http import MediaIoBaseUpload
 
-    try:
-        if file_id:
-            request = service.files().update(fileId=file_id, media_body=media)
-            updated_file = request.execute()
-            logger.info(f"Состояние обновлено на Google Диске (ID: {updated_file.get('id')}).")
-            logger.info(f"Состояние user_answers после сохранения: {user_answers}")
-            logger.info(f"Состояние answer_list после сохранения: {answer_list}")
-            logger.info(f"Состояние roll_pool после сохранения: {roll_pool}")
+        json_data = io.BytesIO(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode('utf-8'))
+        media = MediaIoBaseUpload(json_data, mimetype="application/json")
+
+        try:
+            file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+            updated_file = None
+            if file_id:
+                try:
+                    updated_file = service.files().update(fileId=file_id, media_body=media).execute()
+                except HttpError as error:
+                    if not is_not_found(error):
+                        raise
+                    # Файл удален с Google Диска: ищем его заново или создаем новый
+                    forget_file_id(filename)
+                    file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+                    if file_id:
+                        updated_file = service.files().update(fileId=file_id, media_body=media).execute()
+            if updated_file is not None:
+                logger.info(f"Состояние обновлено на Google Диске (ID: {updated_file.get('id')}).")
+            else:
+                file_metadata = {'name': filename, 'mimeType': 'application/json'}
+                if BASE_FOLDER_ID:
+                    file_metadata['parents'] = [BASE_FOLDER_ID]
+                request = service.files().create(body=file_metadata, media_body=media)
+                created_file = request.execute()
+                remember_file_id(filename, created_file['id'])
+                logger.info(f"Состояние сохранено на Google Диске (ID: {created_file.get('id')}).")
+            return True
+        except HttpError as error:
+            logger.error(f"Ошибка сохранения файла на Google Диске: {error}")
+            return False
+
+    def list(self):
+        return self._list_games()
+
+    def list_recent(self, limit):
+        # Один постраничный запрос заполняет индекс ID всех файлов состояний
+        return self._list_games(order_by="modifiedTime desc")[:limit]
+
+    def prepare_loads(self, chat_ids):
+        filenames = [get_games_filename(chat_id) for chat_id in chat_ids]
+        service = get_gdrive_service()
+        if service and len(filenames) > 1:
+            lookup_file_ids(service, filenames, BASE_FOLDER_ID)
+
+    def _list_games(self, order_by=None):
+        service = get_gdrive_service()
+        if not service:
+            logger.error("Не удалось получить доступ к Google Drive.")
+            return []
+        query = "name contains 'answers_chat_' and trashed=false"
+        if BASE_FOLDER_ID:
+            query += f" and '{BASE_FOLDER_ID}' in parents"
+        games = []
+        page_token = None
+        try:
+            while True:
+                results = service.files().list(q=query, fields="nextPageToken, files(id, name)", orderBy=order_by,
+                                               pageSize=1000, pageToken=page_token).execute()
+                page = {}
+                for item in results.get('files', []):
+                    match = STATE_FILENAME_RE.fullmatch(item['name'])
+                    if match:
+                        page[item['name']] = item['id']
+                        games.append((int(match.group(1)), match.group(2)))
+                # Индекс перезаписывается один раз на страницу, а не на каждый файл
+                remember_file_ids(page)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    return games
+        except HttpError as error:
+            logger.error(f"Ошибка при получении списка файлов: {error}")
+            return games
+
+    def load_games(self, chat_id):
+        service = get_gdrive_service()
+        if not service:
+            logger.error("Не удалось получить доступ к Google Drive.")
+            return None
+        filename = get_games_filename(chat_id)
+        try:
+            file_id = find_file_id(service, filename, BASE_FOLDER_ID)
+            if not file_id:
+                return {}
+            return json.loads(service.files().get_media(fileId=file_id).execute().decode('utf-8'))
+        except HttpError as error:
+            if is_not_found(error):
+                forget_file_id(filename)
+                return {}
+            logger.error(f"Ошибка загрузки списка игр с Google Диска: {error}")
+        except json.JSONDecodeError:
+            logger.error(f"Файл {filename} содержит некорректный JSON.")
+        return None
+
+    def save_games(self, chat_id, games):
+        return self._upload(get_games_filename(chat_id), games)
+
+
+class SqliteStateStore(StateStore):
+    """Хранение состояний в локальной SQLite (режим WAL).
+
+    Ответы и пользователи лежат в отдельных индексированных таблицах, поэтому
+    добавление и удаление ответа - запись одной строки, а не перезапись всей игры.
+    """
+
+    incremental = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            chat_id INTEGER NOT NULL,
+            game_number TEXT NOT NULL,
+            meta TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, game_number)
+        );
+        CREATE TABLE IF NOT EXISTS answers (
+            chat_id INTEGER NOT NULL,
+            game_number TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            user_id INTEGER,
+            text TEXT,
+            weight REAL NOT NULL DEFAULT 1,
+            in_pool INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (chat_id, game_number, number)
+        );
+        CREATE INDEX IF NOT EXISTS answers_by_user ON answers (chat_id, game_number, user_id);
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            games TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER NOT NULL,
+            game_number TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            weight REAL NOT NULL DEFAULT 1,
+            PRIMARY KEY (chat_id, game_number, user_id)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        """Соединение текущего потока."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def load(self, chat_id, game_number):
+        db = self._connection()
+        key = (chat_id, game_number)
+        row = db.execute("SELECT meta FROM games WHERE chat_id = ? AND game_number = ?", key).fetchone()
+        if row is None:
+            return {}
+        state = json.loads(row[0])
+        rows = db.execute("SELECT number, user_id, text, weight, in_pool FROM answers "
+                          "WHERE chat_id = ? AND game_number = ? ORDER BY number", key).fetchall()
+        state["answers"] = [[number, user_id, text] for number, user_id, text, _, _ in rows]
+        state["roll_pool"] = [number for number, _, _, _, in_pool in rows if in_pool]
+        state["answer_weights"] = [[number, weight] for number, _, _, weight, _ in rows if weight != 1]
+        state["user_weights"] = db.execute("SELECT user_id, weight FROM users "
+                                           "WHERE chat_id = ? AND game_number = ?", key).fetchall()
+        logger.info(f"Состояние чата {chat_id} (игра {game_number}) загружено из SQLite.")
+        return state
+
+    def save(self, chat_id, game_number, snapshot, ops, segments=None):
+        # snapshot - meta(): ответы и веса пишутся построчно операциями ops
+        key = (chat_id, game_number)
+        try:
+            with self._connection() as db:
+                for op in ops:
+                    self._apply(db, key, op)
+                db.execute("INSERT OR REPLACE INTO games (chat_id, game_number, meta, updated_at) VALUES (?, ?, ?, ?)",
+                           (*key, json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")), time.time()))
+            return True
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка сохранения состояния чата {chat_id} в SQLite: {error}")
+            return False
+
+    def _apply(self, db, key, op):
+        """Запись одной операции (см. ChatState.apply) отдельными строками."""
+        kind = op["op"]
+        if kind == "add":
+            db.execute("INSERT OR REPLACE INTO answers (chat_id, game_number, number, user_id, text) VALUES (?, ?, ?, ?, ?)",
+                       (*key, op["number"], op["user"], op["text"]))
+        elif kind == "remove":
+            db.execute("DELETE FROM answers WHERE chat_id = ? AND game_number = ? AND number = ?", (*key, op["number"]))
+        elif kind == "exclude":
+            db.execute("UPDATE answers SET user_id = NULL, in_pool = 0 WHERE chat_id = ? AND game_number = ? AND user_id = ?",
+                       (*key, op["user"]))
+        elif kind == "clear":
+            db.execute("DELETE FROM answers WHERE chat_id = ? AND game_number = ?", key)
+        elif kind == "user_weight":
+            if op["weight"] == 1:
+                db.execute("DELETE FROM users WHERE chat_id = ? AND game_number = ? AND user_id = ?", (*key, op["user"]))
+            else:
+                db.execute("INSERT OR REPLACE INTO users (chat_id, game_number, user_id, weight) VALUES (?, ?, ?, ?)",
+                           (*key, op["user"], op["weight"]))
+        elif kind == "answer_weight":
+            db.execute("UPDATE answers SET weight = ? WHERE chat_id = ? AND game_number = ? AND number = ?",
+                       (op["weight"], *key, op["number"]))
+        elif kind == "discard":
+            db.executemany("UPDATE answers SET in_pool = 0 WHERE chat_id = ? AND game_number = ? AND number = ?",
+                           [(*key, number) for number in op["numbers"]])
+        # Операции "set" и "members" меняют только поля meta, они записываются целиком
+
+    def list(self):
+        return self._connection().execute("SELECT chat_id, game_number FROM games").fetchall()
+
+    def list_recent(self, limit):
+        return self._connection().execute("SELECT chat_id, game_number FROM games ORDER BY updated_at DESC LIMIT ?",
+                                          (limit,)).fetchall()
+
+    def delete(self, chat_id, game_number):
+        key = (chat_id, game_number)
+        try:
+            with self._connection() as db:
+                for table in ("games", "answers", "users"):
+                    db.execute(f"DELETE FROM {table} WHERE chat_id = ? AND game_number = ?", key)
+            return True
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка удаления состояния чата {chat_id} из SQLite: {error}")
+            return False
+
+    def load_games(self, chat_id):
+        row = self._connection().execute("SELECT games FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_games(self, chat_id, games):
+        try:
+            with self._connection() as db:
+                db.execute("INSERT OR REPLACE INTO chats (chat_id, games) VALUES (?, ?)",
+                           (chat_id, json.dumps(games, ensure_ascii=False, separators=(",", ":"))))
+            return True
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка сохранения списка игр чата {chat_id} в SQLite: {error}")
+            return False
+
+
+def create_state_store():
+    """Хранилище, выбранное переменной окружения STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "drive":
+        return DriveStateStore()
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStateStore(SQLITE_PATH)
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND!r}")
+
+
+state_store = create_state_store()
+
+class StateLoadError(RuntimeError):
+    """Состояние не удалось загрузить из хранилища; пустое состояние вместо него затерло бы игру при сохранении."""
+
+
+def load_bot_state(chat_id, game_number="default"):
+    """Загрузка состояния чата из хранилища (блокирующий вызов); при ошибке - StateLoadError."""
+    data = state_store.load(chat_id, game_number)
+    if data is None:
+        raise StateLoadError(f"Не удалось загрузить игру {game_number} чата {chat_id}")
+    state = ChatState.from_dict(chat_id, game_number, data)
+    if state_journal.pending(chat_id, game_number):
+        # Операциям из журнала могут понадобиться любые ответы игры
+        for segment in sorted(state.missing_segments):
+            rows = state_store.load_segment(chat_id, game_number, segment)
+            if rows is None:
+                raise StateLoadError(f"Не удалось загрузить сегмент {segment} игры {game_number} чата {chat_id}")
+            state.merge_segment(segment, rows)
+    replayed = state_journal.replay(state)
+    if replayed:
+        logger.info(f"Из журнала восстановлено операций: {replayed}.")
+    logger.info(f"Загружено ответов: {len(state.answers)}, участников: {len(state.leaderboard)}, в розыгрыше: {len(state.roll_pool)}, "
+                f"сегментов ожидает загрузки: {len(state.missing_segments)}.")
+    return state
+
+async def ensure_answers(state, segments=None):
+    """Подгрузка сегментов ответов (всех или перечисленных), которых еще нет в памяти; False при ошибке."""
+    async with state.segments_lock:
+        missing = state.missing_segments if segments is None else state.missing_segments & set(segments)
+        missing = sorted(missing)
+        if not missing:
+            return True
+        loaded = await asyncio.gather(*(run_in_drive_executor(state_store.load_segment, state.chat_id, state.game_number, segment)
+                                        for segment in missing))
+        for segment, rows in zip(missing, loaded):
+            if rows is not None:
+                state.merge_segment(segment, rows)
+        return all(rows is not None for rows in loaded)
+
+async def save_bot_state(state):
+    """Сохранение состояния чата в хранилище без блокировки цикла событий; True при успехе или если сохранять нечего."""
+    async with state.save_lock:
+        if not state.dirty:
+            return True
+        # Снимок собираем в цикле событий, чтобы поток не видел состояние посреди изменения
+        revision = state.revision
+        ops = list(state.pending_ops)
+        segments = None
+        if state_store.incremental:
+            snapshot = state.meta()
+        elif state_store.segmented:
+            segments = state.take_dirty_segments()
+            snapshot = state.manifest()
         else:
-            file_metadata = {'name': filename, 'mimeType': 'application/json'}
-            if BASE_FOLDER_ID:
-                file_metadata['parents'] = [BASE_FOLDER_ID]
-            request = service.files().create(body=file_metadata, media_body=media)
-            created_file = request.execute()
-            logger.info(f"Состояние сохранено на Google Диске (ID: {created_file.get('id')}).")
-            logger.info(f"Состояние user_answers после создания: {user_answers}")
-            logger.info(f"Состояние answer_list после создания: {answer_list}")
-            logger.info(f"Состояние roll_pool после создания: {roll_pool}")
-    except HttpError as error:
-        logger.error(f"Ошибка сохранения файла на Google Диске: {error}")
+            snapshot = state.to_dict()
+        if await run_in_drive_executor(state_store.save, state.chat_id, state.game_number, snapshot, ops, segments):
+            state.saved_revision = max(state.saved_revision, revision)
+            del state.pending_ops[:len(ops)]
+            state_journal.snapshot_saved(state.chat_id, state.game_number, revision)
+            return True
+        if segments:
+            state.dirty_segments.update(segments)
+        return False
+
+
+class StateJournal:
+    """Локальный журнал операций (JSONL, только дозапись).
+
+    Каждая операция над состоянием чата записывается одной строкой с номером
+    seq. Снимок на Google Диск делается раз в SNAPSHOT_EVERY_OPS операций или
+    SNAPSHOT_INTERVAL секунд; при загрузке к снимку применяются операции из
+    журнала с большим seq. Операции, вошедшие в снимок, удаляются при
+    перезаписи журнала.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tail = {}  # (chat_id, game_number) -> операции, еще не вошедшие в снимок
+        self._obsolete = 0  # Строк в файле, уже вошедших в снимки
+        self._file = None
+        if path:
+            self._read()
+            self._file = open(path, "a", encoding="utf-8")
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def _read(self):
+        """Чтение журнала при старте."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная строка после сбоя
+                        logger.warning(f"Пропущена поврежденная строка журнала {self.path}.")
+                        continue
+                    self._tail.setdefault((entry["chat"], entry["game"]), []).append(entry)
+        except FileNotFoundError:
+            return
+        logger.info(f"Журнал {self.path} прочитан: операций {sum(len(ops) for ops in self._tail.values())}.")
+
+    def append(self, state, op):
+        """Запись примененной операции в журнал."""
+        if not self.enabled:
+            return
+        entry = {"chat": state.chat_id, "game": state.game_number, "seq": state.revision, **op}
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self._file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self._file.fileno())
+            self._tail.setdefault((state.chat_id, state.game_number), []).append(entry)
+
+    def replay(self, state):
+        """Применение к загруженному снимку операций, которых в нем еще нет."""
+        with self._lock:
+            entries = [entry for entry in self._tail.get((state.chat_id, state.game_number), [])
+                       if entry["seq"] > state.revision]
+        for entry in entries:
+            state.apply(entry)
+            state.revision = entry["seq"]
+        return len(entries)
+
+    def pending(self, chat_id, game_number):
+        """Есть операции игры, еще не вошедшие в снимок."""
+        with self._lock:
+            return bool(self._tail.get((chat_id, game_number)))
+
+    def snapshot_saved(self, chat_id, game_number, seq):
+        """Операции до seq включительно вошли в снимок и больше не нужны."""
+        with self._lock:
+            entries = self._tail.get((chat_id, game_number))
+            if not entries:
+                return
+            remaining = [entry for entry in entries if entry["seq"] > seq]
+            self._obsolete += len(entries) - len(remaining)
+            if remaining:
+                self._tail[(chat_id, game_number)] = remaining
+            else:
+                del self._tail[(chat_id, game_number)]
+            if self.enabled and self._obsolete >= JOURNAL_COMPACT_LINES:
+                self._compact()
+
+    def _compact(self):
+        """Перезапись журнала только с операциями, которых еще нет в снимках."""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for entries in self._tail.values():
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._obsolete = 0
+        logger.info(f"Журнал {self.path} перезаписан.")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+async def save_states(states):
+    """Сохранение нескольких состояний: общая подготовка (пакетный поиск файлов), затем параллельные загрузки."""
+    states = [state for state in states if state.dirty]
+    if len(states) > 1:
+        saves = [(state.chat_id, state.game_number, sorted(state.dirty_segments)) for state in states]
+        await run_in_drive_executor(state_store.prepare_saves, saves)
+    await asyncio.gather(*(save_bot_state(state) for state in states))
+
+
+class SaveBatcher:
+    """Сбор сохранений разных чатов, наступивших почти одновременно, в одну группу.
+
+    Google Drive API не принимает загрузку содержимого файлов в пакетных
+    запросах, поэтому пакетами идут только поиски файлов, а сами загрузки
+    группы выполняются параллельно.
+    """
+
+    def __init__(self, window=DRIVE_BATCH_WINDOW):
+        self.window = window
+        self._pending = []  # (состояние, future)
+        self._task = None
+
+    async def save(self, state):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((state, future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        await future
+
+    async def _run(self):
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, []
+        self._task = None
+        try:
+            await save_states(list({id(state): state for state, _ in pending}.values()))
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in pending:
+            if not future.done():
+                future.set_result(None)
+
+
+save_batcher = SaveBatcher()
+
+
+class StateFlusher:
+    """Отложенное сохранение снимков состояния на Google Диск.
+
+    Все изменения чата за окно delay сохраняются одной загрузкой; при
+    max_ops несохраненных операциях снимок делается сразу.
+    """
+
+    def __init__(self, delay, max_ops=None):
+        self.delay = delay
+        self.max_ops = max_ops
+        # Ключ - сам объект состояния, а не (chat_id, game_number): после выгрузки и повторной
+        # загрузки игры в памяти новый объект, и ему нужна своя задача сохранения
+        self._tasks = {}  # состояние -> (задача сохранения, событие «сохранить сейчас»)
+
+    def schedule(self, state):
+        """Планирование сохранения измененного состояния."""
+        if state not in self._tasks:
+            flush_now = asyncio.Event()
+            self._tasks[state] = (asyncio.create_task(self._flush_later(state, flush_now)), flush_now)
+        if self.max_ops is not None and state.revision - state.saved_revision >= self.max_ops:
+            self._tasks[state][1].set()
+
+    async def _flush_later(self, state, flush_now):
+        try:
+            # Изменения, сделанные во время загрузки, попадут в следующий снимок
+            while state.dirty:
+                try:
+                    await asyncio.wait_for(flush_now.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+                flush_now.clear()
+                try:
+                    await save_batcher.save(state)
+                except Exception as e:
+                    logger.error(f"Ошибка отложенного сохранения чата {state.chat_id}: {e}")
+        finally:
+            self._tasks.pop(state, None)
+
+    async def drain(self):
+        """Немедленное сохранение всех запланированных изменений (при остановке бота)."""
+        tasks = [task for task, _ in self._tasks.values()]
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await state_cache.flush()
+        logger.info("Все отложенные изменения сохранены на Google Диск.")
+
+
+# С SQLite каждая операция и так пишется отдельной строкой, журнал нужен только для Google Диска.
+# Снимки реже FLUSH_DELAY делаются только с журналом: без него изменения между снимками есть лишь в памяти
+state_journal = StateJournal(JOURNAL_FILE if STORAGE_BACKEND == "drive" else None)
+if state_journal.enabled:
+    state_flusher = StateFlusher(SNAPSHOT_INTERVAL, SNAPSHOT_EVERY_OPS)
+else:
+    state_flusher = StateFlusher(FLUSH_DELAY)
+
+def change_state(state, op):
+    """Изменение состояния чата: применение операции, запись в журнал и планирование снимка."""
+    if not state.apply(op):
+        return False
+    state_journal.append(state, op)
+    state_flusher.schedule(state)
+    return True
 
 def load_whitelist():
     """Загрузка белого списка (локально)"""
@@ -166,6 +2025,402 @@ def save_whitelist(whitelist):
 # Загрузка белого списка при старте
 whitelist = load_whitelist()
 
+# Индекс ID файлов на Google Диске
+file_ids = load_file_ids()
+file_ids_lock = threading.Lock()
+missing_files = {}  # имя файла -> момент, когда пакетный поиск его не нашел
+MISSING_FILE_TTL = 60  # Секунд, в течение которых такой файл не ищется повторно
+
+# Состояния чатов в памяти
+state_cache = ChatStateCache()
+
+
+class ChatGames:
+    """Игры чата: какая активна, названия и архив.
+
+    Каждая игра хранится отдельно (свой файл или свои строки в базе), в памяти
+    держится только активная; список игр - небольшой отдельный документ.
+    """
+
+    def __init__(self, chat_id, data=None):
+        data = data or {}
+        self.chat_id = chat_id
+        self.active = data.get("active", "default")
+        self.next_number = data.get("next_number", 1)
+        self.games = {game["id"]: game for game in data.get("games", [])}
+        if not self.games:
+            # Чат, игравший до появления нескольких игр: его единственная игра - "default"
+            self.games["default"] = {"id": "default", "title": "Основная игра", "created": None, "archived": False}
+
+    def to_dict(self):
+        return {"active": self.active, "next_number": self.next_number, "games": list(self.games.values())}
+
+    def backup(self):
+        """Копия списка игр для отката изменения, которое не удалось сохранить."""
+        return {"active": self.active, "next_number": self.next_number, "games": [dict(game) for game in self.games.values()]}
+
+    def restore(self, backup):
+        """Откат к копии, снятой backup()."""
+        self.__init__(self.chat_id, backup)
+
+    def start(self, title=None):
+        """Новая игра, сразу становится активной."""
+        game_id = str(self.next_number)
+        self.next_number += 1
+        self.games[game_id] = {"id": game_id, "title": title or f"Игра {game_id}",
+                               "created": int(time.time()), "archived": False}
+        self.active = game_id
+        return self.games[game_id]
+
+
+class ChatGamesCache:
+    """Ограниченный LRU-кэш списков игр чатов."""
+
+    def __init__(self, max_size=GAMES_CACHE_SIZE):
+        self.max_size = max_size
+        self._games = OrderedDict()
+        self._loading = {}  # Загрузки, которые уже выполняются
+
+    async def get(self, chat_id):
+        games = self._games.get(chat_id)
+        if games is None:
+            loading = self._loading.get(chat_id)
+            if loading is None:
+                loading = self._loading[chat_id] = asyncio.ensure_future(run_in_drive_executor(state_store.load_games, chat_id))
+                try:
+                    data = await loading
+                finally:
+                    self._loading.pop(chat_id, None)
+            else:
+                data = await loading
+            if data is None:
+                # Пустой список игр вместо незагруженного затер бы игры чата при сохранении
+                raise StateLoadError(f"Не удалось загрузить список игр чата {chat_id}")
+            games = self._games.get(chat_id) or ChatGames(chat_id, data)
+            self._games[chat_id] = games
+        self._games.move_to_end(chat_id)
+        while len(self._games) > self.max_size:
+            self._games.popitem(last=False)
+        return games
+
+    async def save(self, games):
+        return await run_in_drive_executor(state_store.save_games, games.chat_id, games.to_dict())
+
+    def peek(self, chat_id):
+        """Список игр, если он уже в памяти."""
+        return self._games.get(chat_id)
+
+
+chat_games = ChatGamesCache()
+
+async def active_state(chat_id):
+    """Состояние активной игры чата."""
+    games = await chat_games.get(chat_id)
+    return await state_cache.get(chat_id, games.active)
+
+async def prefetch_states(limit=PREFETCH_CHATS, concurrency=PREFETCH_CONCURRENCY, budget=PREFETCH_BUDGET):
+    """Прогрев кэша после запуска: загрузка активных игр недавно измененных чатов.
+
+    Идет параллельно с обработкой обновлений; команда из чата, который еще
+    загружается, дождется той же загрузки. Через budget секунд новые загрузки
+    не начинаются.
+    """
+    started = time.monotonic()
+    deadline = started + budget
+    keys = await run_in_drive_executor(state_store.list_recent, min(limit, state_cache.max_size))
+    await run_in_drive_executor(state_store.prepare_loads, list(dict.fromkeys(chat_id for chat_id, _ in keys)))
+    semaphore = asyncio.Semaphore(concurrency)
+    loaded = 0
+
+    async def load(chat_id, game_number):
+        nonlocal loaded
+        async with semaphore:
+            if time.monotonic() >= deadline:
+                return
+            try:
+                games = await asyncio.shield(chat_games.get(chat_id))
+                if game_number == games.active and await state_cache.prefetch(chat_id, game_number):
+                    loaded += 1
+            except Exception as e:
+                logger.warning(f"Не удалось заранее загрузить чат {chat_id} (игра {game_number}): {e}")
+
+    tasks = [asyncio.ensure_future(load(*key)) for key in keys]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=max(deadline - time.monotonic(), 0))
+        for task in pending:
+            task.cancel()
+    logger.info(f"Прогрев кэша: загружено игр {loaded} из {len(keys)} найденных за {time.monotonic() - started:.1f} с.")
+    return loaded
+
+def start_prefetch(application: Application):
+    """Запуск прогрева кэша в фоне (если задан PREFETCH_CHATS)."""
+    if PREFETCH_CHATS > 0:
+        application.bot_data["prefetch"] = asyncio.create_task(prefetch_states())
+
+async def leave_game(games, game_id):
+    """Выгрузка игры из памяти; число ответов запоминается для списка игр. Возвращает выгруженное состояние."""
+    state = await state_cache.unload(games.chat_id, game_id)
+    if state is not None and game_id in games.games:
+        games.games[game_id]["answers"] = state.answer_count
+    return state
+
+async def carry_members(games, previous):
+    """Перенос справочника участников прежней игры в активную игру чата."""
+    if previous is None or not previous.members:
+        return
+    state = await state_cache.get(games.chat_id, games.active)
+    rows = [row for row in previous.member_rows() if state.members.get(row[0]) != tuple(row[1:])]
+    if rows:
+        change_state(state, {"op": "members", "members": rows})
+
+def remember_members(state, *users):
+    """Запись авторов сообщений в справочник чата; операция пишется, только если что-то изменилось."""
+    rows = [[user.id, user.username, user.full_name] for user in users
+            if user is not None and state.members.get(user.id) != (user.username, user.full_name)]
+    if rows:
+        change_state(state, {"op": "members", "members": rows})
+
+def format_username(user):
+    """Отображаемое имя пользователя Telegram."""
+    return f"@{user.username}" if user.username else user.full_name
+
+
+class NameResolver:
+    """Кэш отображаемых имен пользователей с ограниченным временем жизни."""
+
+    def __init__(self, ttl=NAME_CACHE_TTL, max_size=NAME_CACHE_SIZE, concurrency=NAME_RESOLVE_CONCURRENCY):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._names = OrderedDict()  # user_id -> (имя, момент получения)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def remember(self, user):
+        """Запоминание имени из пришедшего сообщения (без запросов к Bot API)."""
+        if user is None:
+            return
+        self._names[user.id] = (format_username(user), time.monotonic())
+        self._names.move_to_end(user.id)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def get(self, user_id):
+        """Имя из кэша или None, если его нет или оно устарело."""
+        cached = self._names.get(int(user_id))
+        if cached is None or time.monotonic() - cached[1] >= self.ttl:
+            return None
+        return cached[0]
+
+    async def resolve(self, bot, user_id):
+        """Имя пользователя; при промахе кэша - запрос get_chat."""
+        username = self.get(user_id)
+        if username is not None:
+            return username
+        async with self._semaphore:
+            try:
+                user = await bot.get_chat(user_id)
+            except Exception:
+                return f"ID {user_id}"
+        self.remember(user)
+        return format_username(user)
+
+    async def resolve_many(self, bot, user_ids):
+        """Имена нескольких пользователей; промахи разрешаются параллельно."""
+        user_ids = list(dict.fromkeys(user_ids))
+        usernames = await asyncio.gather(*(self.resolve(bot, user_id) for user_id in user_ids))
+        return dict(zip(user_ids, usernames))
+
+
+name_resolver = NameResolver()
+
+
+async def remember_users(update: Update, context: CallbackContext):
+    """Пополнение кэша имен и справочника участников чата из каждого входящего сообщения"""
+    name_resolver.remember(update.effective_user)
+    message = update.effective_message
+    replied = message.reply_to_message.from_user if message and message.reply_to_message else None
+    name_resolver.remember(replied)
+    # Справочник пополняется только в чатах, игра которых уже в памяти: обычная переписка не загружает состояние
+    chat = update.effective_chat
+    games = chat_games.peek(chat.id) if chat else None
+    state = state_cache.peek(chat.id, games.active) if games else None
+    if state is not None:
+        remember_members(state, update.effective_user, replied)
+
+class ChatAdminCache:
+    """Кэш администраторов чатов с ограниченным временем жизни.
+
+    Список загружается get_chat_administrators при первой проверке в чате и
+    затем уточняется по обновлениям ChatMember, поэтому проверка прав обычно
+    обходится без запросов к Bot API.
+    """
+
+    ADMIN_STATUSES = ("administrator", "creator")
+
+    def __init__(self, ttl=ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self._admins = {}  # chat_id -> (ID администраторов, момент загрузки)
+        self._loading = {}  # Загрузки, которые уже выполняются
+
+    async def get(self, bot, chat_id):
+        """ID администраторов чата; None, если список получить не удалось."""
+        cached = self._admins.get(chat_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.ensure_future(self._load(bot, chat_id))
+            try:
+                return await loading
+            finally:
+                self._loading.pop(chat_id, None)
+        return await loading
+
+    async def _load(self, bot, chat_id):
+        try:
+            members = await bot.get_chat_administrators(chat_id)
+        except TelegramError as e:
+            logger.warning(f"Не удалось получить администраторов чата {chat_id}: {e}")
+            return None
+        admins = {member.user.id for member in members}
+        self._admins[chat_id] = (admins, time.monotonic())
+        return admins
+
+    async def is_admin(self, bot, chat_id, user_id):
+        admins = await self.get(bot, chat_id)
+        return admins is not None and user_id in admins
+
+    def member_updated(self, chat_id, user_id, status):
+        """Учет изменения прав участника (из обновления ChatMember)."""
+        cached = self._admins.get(chat_id)
+        if cached is None:
+            return
+        if status in self.ADMIN_STATUSES:
+            cached[0].add(user_id)
+        else:
+            cached[0].discard(user_id)
+
+
+chat_admins = ChatAdminCache()
+
+async def is_authorized(update: Update, context: CallbackContext):
+    """Право управлять ботом в чате: белый список или администратор этого чата."""
+    user = update.effective_user
+    if user and user.id in whitelist:
+        return True
+    if not CHAT_ADMINS_AUTHORIZED or update.effective_chat is None or update.effective_chat.type == "private":
+        return False
+    message = update.effective_message
+    if message and message.sender_chat and message.sender_chat.id == update.effective_chat.id:
+        # Анонимный администратор пишет от имени самого чата
+        return True
+    return user is not None and await chat_admins.is_admin(context.bot, update.effective_chat.id, user.id)
+
+async def track_chat_admins(update: Update, context: CallbackContext):
+    """Обновление кэша администраторов при изменении прав участника"""
+    change = update.chat_member
+    chat_admins.member_updated(change.chat.id, change.new_chat_member.user.id, change.new_chat_member.status)
+
+class UpdateRecorder:
+    """Запись входящих обновлений в JSONL для воспроизведения (replay.py).
+
+    Сохраняются только поля из ALLOWED_KEYS, нужные обработчикам; контакты,
+    геопозиции, файлы и прочие вложения отбрасываются. Все id и user_id на
+    любой глубине заменяются псевдонимами (HMAC с ключом RECORD_SALT), имена и
+    логины - псевдонимами той же длины. Из текстов остаются только команды
+    бота (упоминания @логин и ID пользователей в аргументах тоже заменяются),
+    остальной текст и подписи заменяются заглушкой.
+    """
+
+    ALLOWED_KEYS = {
+        # Обновление и сообщение
+        "update_id", "message", "edited_message", "my_chat_member", "chat_member",
+        "message_id", "message_thread_id", "is_topic_message", "date", "edit_date",
+        "chat", "from", "sender_chat", "reply_to_message", "new_chat_members", "left_chat_member",
+        "text", "caption", "entities", "caption_entities", "offset", "length",
+        # Пользователи, чаты и участники
+        "id", "user_id", "user", "type", "is_bot", "is_forum", "first_name", "last_name", "username", "title",
+        "old_chat_member", "new_chat_member", "status", "until_date",
+    }
+    ID_KEYS = ("id", "user_id")
+    NAME_KEYS = ("first_name", "last_name", "username", "title")
+    COMMAND_RE = re.compile(r"(/\S+|\+\+|плюс|!?мрр)(\s|$)", re.IGNORECASE)  # Тексты, на которые отвечает бот
+    USER_ID_COMMANDS = {"/rpr_modify", "мрр", "!мрр", "/rpr_weight", "/rpr_wladd", "/rpr_wldel"}  # Первый аргумент - ID пользователя
+
+    def __init__(self, path, salt):
+        self.path = path
+        self._key = salt.encode()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _digest(self, value):
+        return hmac.new(self._key, str(value).encode(), hashlib.sha256).hexdigest()
+
+    def pseudonym_id(self, value):
+        """Псевдоним ID со знаком исходного (ID групп отрицательные)."""
+        pseudonym = int(self._digest(value)[:12], 16)
+        return -pseudonym if value < 0 else pseudonym
+
+    def pseudonym_text(self, value):
+        """Псевдоним строки той же длины (смещения entities не сдвигаются)."""
+        digest = self._digest(value)
+        return (digest * (len(value) // len(digest) + 1))[:len(value)]
+
+    def anonymize_text(self, value):
+        """Команда бота с замененными @логинами и ID пользователей; любой другой текст - заглушка той же длины."""
+        if not self.COMMAND_RE.match(value):
+            return "x" * len(value)
+        # Четные элементы - слова, нечетные - пробелы между ними; /команда@бот остается как есть
+        parts = re.split(r"(\s+)", value)
+        for index in range(2, len(parts), 2):
+            parts[index] = re.sub(r"@(\w+)", lambda match: "@" + self.pseudonym_text(match.group(1)), parts[index])
+        command = parts[0].split("@")[0].lower()
+        # У /rpr_weight единственный аргумент - вес, а не ID
+        if command in self.USER_ID_COMMANDS and len(parts) > 2 and (command != "/rpr_weight" or len(parts) > 4):
+            if re.fullmatch(r"-?\d+", parts[2]):
+                parts[2] = str(self.pseudonym_id(int(parts[2])))
+        return "".join(parts)
+
+    def anonymize(self, data):
+        """Обезличенная копия словаря обновления."""
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for key, value in data.items():
+            if key.startswith(("can_", "is_")) and isinstance(value, bool):
+                # Права участника обязательны при разборе ChatMemberAdministrator
+                result[key] = value
+            elif key not in self.ALLOWED_KEYS:
+                continue
+            elif key in self.ID_KEYS and isinstance(value, int) and not isinstance(value, bool):
+                result[key] = self.pseudonym_id(value)
+            elif key in self.NAME_KEYS and isinstance(value, str):
+                result[key] = self.pseudonym_text(value)
+            elif key == "text" and isinstance(value, str):
+                result[key] = self.anonymize_text(value)
+            elif key == "caption" and isinstance(value, str):
+                result[key] = "x" * len(value)
+            else:
+                result[key] = self.anonymize(value)
+        return result
+
+    def record(self, update: Update, admin):
+        """Запись одного обновления; admin - отправитель был в белом списке."""
+        line = {"ts": round(time.time(), 3), "admin": admin, "update": self.anonymize(update.to_dict())}
+        self._file.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_FILE, RECORD_SALT or f"record:{TOKEN}") if RECORD_UPDATES_FILE else None
+
+async def record_update(update: Update, context: CallbackContext):
+    """Запись обновления до его обработки"""
+    user = update.effective_user
+    update_recorder.record(update, admin=bool(user) and user.id in whitelist)
+
 async def start(update: Update, context: CallbackContext):
     """Стартовая команда"""
     await update.message.reply_text(
@@ -173,93 +2428,242 @@ async def start(update: Update, context: CallbackContext):
         "Основные команды: ++ - добавить ответ /rprlb - показать таблицу лидеров /rpr - розыгрыш победителя"
     )
 
-async def _format_leaderboard(user_answers, context):
-    """Форматирование таблицы лидеров"""
-    logger.info(f"Состояние user_answers в _format_leaderboard: {user_answers}")
-    if not user_answers:
+def points_word(score):
+    """Склонение слова «балл»."""
+    return f"балл{'а' if 2 <= score <= 4 else 'ов' if score >= 5 or score == 0 else ''}"
+
+async def require_answers(update, state, segments=None):
+    """ensure_answers с сообщением пользователю при ошибке загрузки."""
+    if await ensure_answers(state, segments):
+        return True
+    await update.message.reply_text("Не удалось загрузить ответы игры, попробуйте позже.")
+    return False
+
+async def _format_leaderboard(state, bot, limit=None):
+    """Форматирование таблицы лидеров; с limit - только первые limit мест сводки"""
+    if not len(state.leaderboard):
         return "🏆 Таблица лидеров пуста."
 
+    top = state.leaderboard.top(limit)
+    if limit is not None:
+        # Для top-K достаточно рейтинга, полный список ответов не нужен
+        usernames = await name_resolver.resolve_many(bot, (user_id for user_id, _ in top))
+        leaderboard = f"🏆 *Топ-{limit}* 🏆\n\n"
+        for place, (user_id, score) in enumerate(top, start=1):
+            leaderboard += f"{place}. {usernames[user_id]} — {score} {points_word(score)}\n"
+        return leaderboard
+
+    # Полный список выводит все ответы: догружаем сегменты, которых нет в памяти
+    if not await ensure_answers(state):
+        return "Не удалось загрузить ответы игры, попробуйте позже."
+    user_answers = state.user_answers
     leaderboard = "🏆 *Таблица лидеров* 🏆\n\n"
 
-    all_answers_with_text = []
-    for user_id, answers in user_answers.items():
-        try:
-            user = await context.bot.get_chat(user_id)
-            username = f"@{user.username}" if user.username else user.full_name
-        except Exception:
-            username = f"ID {user_id}"
-        for answer in answers:
-            all_answers_with_text.append((answer["number"], username, answer["text"]))
-
-    # Сортируем ответы по номеру (порядку добавления)
-    all_answers_with_text.sort(key=lambda item: item[0])
+    # Каждый пользователь разрешается не более одного раза за отрисовку
+    usernames = await name_resolver.resolve_many(bot, user_answers.keys())
 
-    # Перенумеруем ответы при выводе
+    # Индекс ответов уже упорядочен по номеру (порядку добавления)
     leaderboard_entries = []
     current_number = 1
-    for _, username, text in all_answers_with_text:
-        leaderboard_entries.append(f"{current_number}. {username} - {text}")
+    for number, answer in state.answers.items():
+        user_id = state.owners.get(number)
+        if user_id not in user_answers:
+            continue
+        # Перенумеруем ответы при выводе
+        leaderboard_entries.append(f"{current_number}. {usernames[user_id]} - {answer['text']}")
         current_number += 1
     leaderboard += "\n".join(leaderboard_entries)
 
     leaderboard += "\n\n📊 *Сводка по баллам:*\n"
-    user_scores = {}
-    for user_id, answers in user_answers.items():
-        try:
-            user = await context.bot.get_chat(user_id)
-            username = f"@{user.username}" if user.username else user.full_name
-        except Exception:
-            username = f"ID {user_id}"
-        user_scores[username] = len(answers)
-    logger.info(f"Рассчитанные user_scores: {user_scores}")
-    sorted_scores = sorted(user_scores.items(), key=lambda item: item[1], reverse=True)
-    for username, score in sorted_scores:
-        leaderboard += f"{username} — {score} балл{'а' if 2 <= score <= 4 else 'ов' if score >= 5 or score == 0 else ''}\n"
+    for user_id, score in top:
+        leaderboard += f"{usernames[user_id]} — {score} {points_word(score)}\n"
 
     return leaderboard
 
+def _telegram_length(text):
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Разбиение текста на сообщения не длиннее limit по границам строк."""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while _telegram_length(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            cut = limit
+            while _telegram_length(line[:cut]) > limit:
+                cut -= 1
+            chunks.append(line[:cut])
+            line = line[cut:]
+        if current and _telegram_length(current) + 1 + _telegram_length(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current.strip():
+        chunks.append(current)
+    return chunks or [text]
+
+
+class LiveLeaderboard:
+    """Живая таблица лидеров: одно закрепленное сообщение на игру, обновляемое редактированием.
+
+    Частые правки собираются в одну за LIVE_EDIT_DELAY, а текст длиннее
+    лимита Telegram продолжается в дополнительных сообщениях; правятся только
+    сообщения, текст которых изменился. В играх больше PLUS_FULL_LEADERBOARD_MAX
+    ответов таблица показывает только первые PLUS_TOP_PLACES мест.
+    """
+
+    def __init__(self, delay=LIVE_EDIT_DELAY):
+        self.delay = delay
+        # У каждой игры свои сообщения таблицы, поэтому ключ - (chat_id, game_number)
+        self._timers = {}  # (chat_id, game_number) -> задача отложенного обновления
+        self._locks = {}  # (chat_id, game_number) -> [блокировка, число ожидающих обновлений]
+        self._sent = {}  # (chat_id, message_id) -> хэш последнего текста сообщения таблицы
+
+    @staticmethod
+    def _key(state):
+        return (state.chat_id, state.game_number)
+
+    def schedule(self, state, bot):
+        """Планирование обновления таблицы игры."""
+        key = self._key(state)
+        if key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._refresh_later(key, bot))
+
+    async def _refresh_later(self, key, bot):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            if self._timers.get(key) is asyncio.current_task():
+                del self._timers[key]
+        # Игру могли выгрузить за время ожидания: изменения выгруженного объекта затерли бы сохраненную игру
+        state = state_cache.peek(*key)
+        if state is None or not state.live_leaderboard:
+            return
+        try:
+            await self.refresh(state, bot)
+        except Exception as e:
+            logger.error(f"Ошибка обновления живой таблицы чата {state.chat_id}: {e}")
+
+    async def refresh(self, state, bot):
+        """Немедленное обновление таблицы игры."""
+        key = self._key(state)
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        # Блокировка удаляется, когда ее никто не ждет, иначе словарь рос бы на каждый чат
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._render(state, bot)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    @staticmethod
+    async def _text(state, bot):
+        """Текст таблицы: полный список ответов или, в большой игре, первые места."""
+        if state.answer_count <= PLUS_FULL_LEADERBOARD_MAX:
+            return await _format_leaderboard(state, bot)
+        # Полный список большой игры - все сегменты и десятки правок на каждое изменение
+        return f"{await _format_leaderboard(state, bot, PLUS_TOP_PLACES)}\nПолная таблица: /rprlb"
+
+    async def _render(self, state, bot):
+        """Отправка и правка сообщений таблицы."""
+        chunks = split_message(await self._text(state, bot))
+        message_ids = list(state.leaderboard_message_ids)
+        new_message_ids = []
+        for index, chunk in enumerate(chunks):
+            digest = hash(chunk)
+            if index < len(message_ids):
+                sent_key = (state.chat_id, message_ids[index])
+                if self._sent.get(sent_key) == digest:
+                    new_message_ids.append(message_ids[index])
+                    continue
+                try:
+                    await bot.edit_message_text(chunk, chat_id=state.chat_id, message_id=message_ids[index],
+                                                parse_mode='Markdown')
+                    self._sent[sent_key] = digest
+                    new_message_ids.append(message_ids[index])
+                    continue
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        self._sent[sent_key] = digest
+                        new_message_ids.append(message_ids[index])
+                        continue
+                    # Сообщение удалено или недоступно: отправляем новое
+                    self._sent.pop(sent_key, None)
+                    logger.info(f"Не удалось отредактировать таблицу чата {state.chat_id}: {e}")
+            message = await bot.send_message(state.chat_id, chunk, parse_mode='Markdown')
+            self._sent[(state.chat_id, message.message_id)] = digest
+            new_message_ids.append(message.message_id)
+            if index == 0:
+                try:
+                    await bot.pin_chat_message(state.chat_id, message.message_id, disable_notification=True)
+                except Exception as e:
+                    logger.info(f"Не удалось закрепить таблицу в чате {state.chat_id}: {e}")
+        # Лишние сообщения-продолжения удаляем
+        for message_id in message_ids[len(chunks):]:
+            self._sent.pop((state.chat_id, message_id), None)
+            try:
+                await bot.delete_message(state.chat_id, message_id)
+            except Exception as e:
+                logger.info(f"Не удалось удалить сообщение {message_id} в чате {state.chat_id}: {e}")
+        if new_message_ids != message_ids:
+            change_state(state, {"op": "set", "values": {"leaderboard_message_ids": new_message_ids}})
+
+
+live_leaderboard = LiveLeaderboard()
+
+def leaderboard_changed(state, bot):
+    """Обновление живой таблицы после изменения ответов"""
+    if state.live_leaderboard:
+        live_leaderboard.schedule(state, bot)
+
 async def add_answer(update: Update, context: CallbackContext):
     """Добавление ответа"""
-    if update.effective_user.id not in whitelist:
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
+    state = await active_state(chat_id)
 
     try:
         command = update.message.text.strip().lower()
 
         if command in ["++", "плюс", "/add", "/plus"]:
             if update.message.reply_to_message:
-                if len(answer_list) >= 100:
-                    await update.message.reply_text("Достигнут лимит в 100 ответов.")
+                # Нужен только сегмент, в который попадет новый ответ
+                if not await require_answers(update, state, [state.segment_of(state.next_number)]):
                     return
 
-                user_id = update.message.reply_to_message.from_user.id
-                answer_number = len(answer_list) + 1
-                message_text = update.message.reply_to_message.text
-                answer_data = {"number": answer_number, "text": message_text}
-                answer_list.append(answer_data)
-                roll_pool.append(answer_number)
+                author = update.message.reply_to_message.from_user
+                name_resolver.remember(author)
+                remember_members(state, update.effective_user, author)
+                change_state(state, {"op": "add", "user": author.id, "text": update.message.reply_to_message.text,
+                                     "number": state.next_number})
 
-                if user_id not in user_answers:
-                    user_answers[user_id] = []
-                user_answers[user_id].append(answer_data)
+                if state.live_leaderboard:
+                    # Без отдельных сообщений: закрепленная таблица обновится сама
+                    leaderboard_changed(state, context.bot)
+                    return
 
-                try:
-                    user = await context.bot.get_chat(user_id)
-                    username = f"@{user.username}" if user.username else user.full_name
-                except Exception:
-                    username = f"ID {user_id}"
-
-                total_answers = len(user_answers[user_id])
-                await update.message.reply_text(f"Ответ пользователя {username} добавлен. Всего ответов: {total_answers} балл{'а' if 2 <= total_answers <= 4 else 'ов' if total_answers >= 5 or total_answers == 0 else ''}.")
-                logger.info(f"Состояние user_answers перед сохранением: {user_answers}") # Добавлено логирование
-                logger.info(f"Состояние answer_list перед сохранением: {answer_list}") # Добавлено логирование
-                logger.info(f"Состояние roll_pool перед сохранением: {roll_pool}") # Добавлено логирование
-                await show_leaderboard(update, context)
-                save_bot_state(chat_id)
-                logger.info(f"Состояние user_answers после сохранения: {user_answers}") # Добавлено логирование
+                username = format_username(author)
+
+                total_answers = state.leaderboard.score(author.id)
+                await update.message.reply_text(f"Ответ пользователя {username} добавлен. Всего ответов: {total_answers} {points_word(total_answers)}.")
+                if state.answer_count <= PLUS_FULL_LEADERBOARD_MAX:
+                    await show_leaderboard(update, context)
+                else:
+                    # Полная таблица большой игры - все сегменты и десятки сообщений на каждый ++
+                    top = await _format_leaderboard(state, context.bot, PLUS_TOP_PLACES)
+                    await update.message.reply_text(f"{top}\nПолная таблица: /rprlb", parse_mode='Markdown')
             else:
                 await show_leaderboard(update, context)
 
@@ -275,23 +2679,51 @@ async def add_answer(update: Update, context: CallbackContext):
 
 async def show_leaderboard(update: Update, context: CallbackContext):
     """Показ таблицы лидеров"""
-    if update.effective_user.id not in whitelist:
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    # load_bot_state(chat_id) # Убираем лишнюю загрузку
-    logger.info(f"Состояние user_answers в show_leaderboard после (предполагаемой) загрузки: {user_answers}") # Логирование
-    leaderboard = await _format_leaderboard(user_answers, context)
-    await update.message.reply_text(leaderboard, parse_mode='Markdown')
-    save_bot_state(chat_id)
+    state = await active_state(chat_id)
+    try:
+        # /rprlb <K> - только первые K мест
+        limit = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("Используйте: /rprlb или /rprlb <количество мест>")
+        return
+    if limit is not None and limit <= 0:
+        await update.message.reply_text("Используйте: /rprlb или /rprlb <количество мест>")
+        return
+    if state.live_leaderboard and limit is None and state.answer_count <= PLUS_FULL_LEADERBOARD_MAX:
+        # В большой игре живая таблица показывает только первые места, полная выводится отдельно
+        await live_leaderboard.refresh(state, context.bot)
+        return
+    leaderboard = await _format_leaderboard(state, context.bot, limit)
+    for chunk in split_message(leaderboard):
+        await update.message.reply_text(chunk, parse_mode='Markdown')
+
+async def show_rank(update: Update, context: CallbackContext):
+    """Место пользователя в рейтинге (своё или автора сообщения, на которое дан ответ)"""
+    if not await is_authorized(update, context):
+        return
+
+    state = await active_state(update.effective_chat.id)
+    reply = update.message.reply_to_message
+    user = reply.from_user if reply else update.effective_user
+    username = format_username(user)
+    rank = state.leaderboard.rank(user.id)
+    if rank is None:
+        await update.message.reply_text(f"{username} пока нет в таблице лидеров.")
+        return
+    score = state.leaderboard.score(user.id)
+    await update.message.reply_text(f"🏅 {username}: {rank} место из {len(state.leaderboard)}, {score} {points_word(score)}.")
 
 async def remove_answer(update: Update, context: CallbackContext):
     """Удаление ответа"""
-    if update.effective_user.id not in whitelist:
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
+    state = await active_state(chat_id)
 
     try:
         if not context.args:
@@ -299,23 +2731,12 @@ async def remove_answer(update: Update, context: CallbackContext):
             return
 
         answer_number_to_remove = int(context.args[0])
-
-        # Удаляем ответ из answer_list
-        answer_list[:] = [item for item in answer_list if item["number"] != answer_number_to_remove]
-
-        # Удаляем ответ из roll_pool
-        if answer_number_to_remove in roll_pool:
-            roll_pool.remove(answer_number_to_remove)
-
-        # Удаляем ответ у всех пользователей
-        for user_id in list(user_answers.keys()):
-            user_answers[user_id] = [item for item in user_answers[user_id] if item["number"] != answer_number_to_remove]
-            if not user_answers[user_id]:
-                del user_answers[user_id]
-
-        # Корректировка номеров оставшихся ответов (необязательно при новой структуре)
-
-        save_bot_state(chat_id)
+        if not await require_answers(update, state, [state.segment_of(answer_number_to_remove)]):
+            return
+        if not change_state(state, {"op": "remove", "number": answer_number_to_remove}):
+            await update.message.reply_text(f"Ответ №{answer_number_to_remove} не найден.")
+            return
+        leaderboard_changed(state, context.bot)
         await update.message.reply_text(f"Ответ №{answer_number_to_remove} удален.")
 
     except (ValueError, IndexError):
@@ -325,88 +2746,146 @@ async def remove_answer(update: Update, context: CallbackContext):
         await update.message.reply_text("Произошла ошибка при удалении ответа.")
 
 async def roll_winner(update: Update, context: CallbackContext):
-    """Розыгрыш победителя"""
-    if update.effective_user.id not in whitelist:
+    """Розыгрыш победителя (/rpr <N> - сразу N победителей без повторов)"""
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
+    state = await active_state(chat_id)
+
+    try:
+        count = int(context.args[0]) if context.args else 1
+    except ValueError:
+        count = 0
+    if count <= 0:
+        await update.message.reply_text("Используйте: /rpr или /rpr <количество победителей>")
+        return
 
-    if not roll_pool:
+    if not await require_answers(update, state):
+        return
+    if not state.roll_pool:
         await update.message.reply_text("Список ответов пуст.")
         return
 
-    winner_number = random.choice(roll_pool)
-    winner_user_id = None
-    winning_answer_text = None
-    for user_id, answers in user_answers.items():
-        for answer in answers:
-            if answer["number"] == winner_number:
-                winner_user_id = user_id
-                break
-        if winner_user_id:
-            break
+    winners = state.draw(count)
+    if state.exclude_winners and winners:
+        change_state(state, {"op": "discard", "numbers": state.winner_numbers(winners)})
+    if not winners or not all(user_id is not None for _, user_id in winners):
+        await update.message.reply_text("Не удалось определить победителя.")
+        return
 
-    # Находим текст выигрышного ответа
-    for answer in answer_list:
-        if answer["number"] == winner_number:
-            winning_answer_text = answer["text"]
-            break
+    usernames = await name_resolver.resolve_many(context.bot, (user_id for _, user_id in winners))
+    lines = []
+    for winner_number, winner_user_id in winners:
+        winning_answer_text = state.answers.get(winner_number, {}).get("text")
+        if winning_answer_text:
+            lines.append(f"{usernames[winner_user_id]}, ответ №{winner_number} '{winning_answer_text}'")
+        else:
+            lines.append(f"{usernames[winner_user_id]}, ответ №{winner_number}")
 
-    if winner_user_id:
-        try:
-            winner = await context.bot.get_chat(winner_user_id)
-            winner_username = f"@{winner.username}" if winner.username else winner.full_name
-        except Exception:
-            winner_username = f"ID {winner_user_id}"
+    if len(lines) == 1:
+        await update.message.reply_text(f"🎉 Выиграл: {lines[0]}")
+    else:
+        text = "🎉 Победители:\n" + "\n".join(f"{place}. {line}" for place, line in enumerate(lines, start=1))
+        if len(lines) < count:
+            text += f"\n\nУчастников в розыгрыше меньше, чем {count}."
+        for chunk in split_message(text):
+            await update.message.reply_text(chunk)
+
+async def set_roll_weight(update: Update, context: CallbackContext):
+    """Вес участника или ответа в розыгрыше"""
+    if not await is_authorized(update, context):
+        return
 
-        if winning_answer_text:
-            await update.message.reply_text(f"🎉 Выиграл: {winner_username}, ответ №{winner_number} '{winning_answer_text}'")
+    usage = ("Используйте: /rpr_weight <id пользователя> <вес>, /rpr_weight #<номер ответа> <вес> "
+             "или /rpr_weight <вес> в ответ на сообщение участника")
+    state = await active_state(update.effective_chat.id)
+    try:
+        weight = float(context.args[-1])
+        # float() принимает nan и inf, а они ломают выбор по весам и сохранились бы в состоянии
+        if not math.isfinite(weight) or weight < 0:
+            raise ValueError
+        target = context.args[0] if len(context.args) > 1 else None
+        if target is not None and target[0] in "#№":
+            number = int(target[1:])
+            if not await require_answers(update, state, [state.segment_of(number)]):
+                return
+            if not change_state(state, {"op": "answer_weight", "number": number, "weight": weight}):
+                await update.message.reply_text(f"Ответ №{number} не найден.")
+                return
+            message = f"Вес ответа №{number} в розыгрыше: {weight:g}."
         else:
-            await update.message.reply_text(f"🎉 Выиграл: {winner_username}, ответ №{winner_number}")
+            reply = update.message.reply_to_message
+            if target is not None:
+                user_id = int(target)
+            elif reply:
+                user_id = reply.from_user.id
+            else:
+                raise ValueError
+            change_state(state, {"op": "user_weight", "user": user_id, "weight": weight})
+            message = f"Вес пользователя {user_id} в розыгрыше: {weight:g}."
+    except (ValueError, IndexError, TypeError):
+        await update.message.reply_text(usage)
+        return
+    await update.message.reply_text(message)
+
+async def toggle_exclude_winners(update: Update, context: CallbackContext):
+    """Включение и выключение автоматического исключения победителей"""
+    if not await is_authorized(update, context):
+        return
+
+    state = await active_state(update.effective_chat.id)
+    change_state(state, {"op": "set", "values": {"exclude_winners": not state.exclude_winners}})
+    if state.exclude_winners:
+        await update.message.reply_text("Победители теперь автоматически исключаются из следующих розыгрышей.")
     else:
-        await update.message.reply_text("Не удалось определить победителя.")
+        await update.message.reply_text("Автоматическое исключение победителей выключено.")
 
 async def modify_roll(update: Update, context: CallbackContext):
     """Исключение пользователя из розыгрыша"""
-    if update.effective_user.id not in whitelist:
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
+    state = await active_state(chat_id)
 
     try:
-        target_user_id = int(context.args[0]) if context.args[0].isdigit() else (await context.bot.get_chat_member(update.effective_chat.id, context.args[0][1:])).user.id
-
-        if target_user_id in user_answers:
-            # Удаляем все ответы пользователя из roll_pool
-            for answer in user_answers[target_user_id]:
-                if answer["number"] in roll_pool:
-                    roll_pool.remove(answer["number"])
+        # У текстовой команды «мрр» context.args нет, аргументы берутся из текста
+        args = context.args if context.args is not None else update.message.text.split()[1:]
+        reply = update.message.reply_to_message
+        if not args and reply and reply.from_user:
+            target_user_id = reply.from_user.id
+        elif args[0].startswith("@"):
+            # get_chat_member не принимает логины, поэтому логин ищется в справочнике чата
+            target_user_id = state.find_member(args[0])
+            if target_user_id is None:
+                await update.message.reply_text(f"Пользователь {args[0]} еще не писал в этом чате, укажите его ID.")
+                return
+        else:
+            target_user_id = int(args[0])
 
-            del user_answers[target_user_id]
-            save_bot_state(chat_id)
+        if not await require_answers(update, state):
+            return
+        if change_state(state, {"op": "exclude", "user": target_user_id}):
+            leaderboard_changed(state, context.bot)
 
             await update.message.reply_text("Пользователь исключен из розыгрыша.")
         else:
             await update.message.reply_text("Пользователь не найден.")
 
     except (ValueError, IndexError):
-        await update.message.reply_text("Используйте: !мрр @<tglink> или !мрр <id пользователя>")
+        await update.message.reply_text("Используйте: мрр @<логин>, мрр <id пользователя> или мрр в ответ на сообщение участника")
 
 async def add_to_whitelist(update: Update, context: CallbackContext):
     """Добавление пользователя в белый список"""
     if update.effective_user.id not in whitelist:
         return
 
-    chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
     try:
         user_id = int(context.args[0])
         whitelist.add(user_id)
         save_whitelist(whitelist)
         await update.message.reply_text(f"Пользователь {user_id} добавлен в вайтлист.")
-        save_bot_state(chat_id)
     except (ValueError, IndexError):
         await update.message.reply_text("Используйте: /rpr_wladd <id пользователя>")
 
@@ -415,46 +2894,371 @@ async def remove_from_whitelist(update: Update, context: CallbackContext):
     if update.effective_user.id not in whitelist:
         return
 
-    chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
     try:
         user_id = int(context.args[0])
         whitelist.discard(user_id)
         save_whitelist(whitelist)
         await update.message.reply_text(f"Пользователь {user_id} удален из вайтлиста.")
-        save_bot_state(chat_id)
     except (ValueError, IndexError):
         await update.message.reply_text("Используйте: /rpr_wldel <id пользователя>")
 
 async def clear_ratio(update: Update, context: CallbackContext):
     """Очистка всех данных"""
-    if update.effective_user.id not in whitelist:
+    if not await is_authorized(update, context):
         return
 
     chat_id = update.effective_chat.id
-    load_bot_state(chat_id)
-    global user_answers, answer_list, roll_pool
-    user_answers.clear()
-    answer_list.clear()
-    roll_pool.clear()
-    save_bot_state(chat_id)
+    state = await active_state(chat_id)
+    change_state(state, {"op": "clear"})
+    leaderboard_changed(state, context.bot)
 
     await update.message.reply_text("Таблица лидеров и список ответов очищены.")
 
-def main():
-    """Основная функция запуска бота"""
+def game_title(game):
+    """Название игры для сообщений."""
+    return f"№{game['id']} «{game['title']}»" if game["id"] != "default" else f"«{game['title']}»"
+
+async def save_games(update, games, backup):
+    """Сохранение списка игр; при ошибке список откатывается к backup и пользователь получает сообщение."""
+    if await chat_games.save(games):
+        return True
+    # Иначе после перезапуска вернулась бы прежняя активная игра, а новая пропала бы из списка
+    games.restore(backup)
+    await update.message.reply_text("Не удалось сохранить список игр, попробуйте позже.")
+    return False
+
+async def new_game(update: Update, context: CallbackContext):
+    """Начало новой игры; текущая сохраняется и остается в списке игр"""
+    if not await is_authorized(update, context):
+        return
+
+    games = await chat_games.get(update.effective_chat.id)
+    backup = games.backup()
+    previous = games.active
+    left = await leave_game(games, previous)
+    game = games.start(" ".join(context.args) or None)
+    if not await save_games(update, games, backup):
+        return
+    await carry_members(games, left)
+    await update.message.reply_text(f"Начата игра {game_title(game)}. Предыдущая игра сохранена: /rpr_game {previous}")
+
+async def switch_game(update: Update, context: CallbackContext):
+    """Переключение на другую игру чата"""
+    if not await is_authorized(update, context):
+        return
+
+    games = await chat_games.get(update.effective_chat.id)
+    if not context.args:
+        await update.message.reply_text("Используйте: /rpr_game <номер игры> (список игр: /rpr_games)")
+        return
+    game = games.games.get(context.args[0])
+    if game is None:
+        await update.message.reply_text(f"Игра {context.args[0]} не найдена. Список игр: /rpr_games")
+        return
+    backup = games.backup()
+    left = None
+    if game["id"] != games.active:
+        left = await leave_game(games, games.active)
+        games.active = game["id"]
+    game["archived"] = False
+    if not await save_games(update, games, backup):
+        return
+    await carry_members(games, left)
+    await update.message.reply_text(f"Активна игра {game_title(game)}.")
+
+async def list_games(update: Update, context: CallbackContext):
+    """Список игр чата"""
+    if not await is_authorized(update, context):
+        return
+
+    games = await chat_games.get(update.effective_chat.id)
+    lines = ["🎲 Игры чата:"]
+    for archived in (False, True):
+        listed = [game for game in games.games.values() if game["archived"] == archived]
+        if archived and listed:
+            lines.append("\n🗄 Архив:")
+        for game in listed:
+            details = []
+            if game.get("created"):
+                details.append(time.strftime("%d.%m.%Y", time.localtime(game["created"])))
+            if game["id"] == games.active:
+                state = await active_state(games.chat_id)
+                details.append(f"ответов: {state.answer_count}")
+            elif "answers" in game:
+                details.append(f"ответов: {game['answers']}")
+            marker = "▶️ " if game["id"] == games.active else ""
+            suffix = f" ({', '.join(details)})" if details else ""
+            lines.append(f"{marker}{game['id']}: {game['title']}{suffix}")
+    await update.message.reply_text("\n".join(lines))
+
+async def archive_game(update: Update, context: CallbackContext):
+    """Перенос игры в архив; вместо активной игры начинается новая"""
+    if not await is_authorized(update, context):
+        return
+
+    games = await chat_games.get(update.effective_chat.id)
+    game_id = context.args[0] if context.args else games.active
+    game = games.games.get(game_id)
+    if game is None:
+        await update.message.reply_text(f"Игра {game_id} не найдена. Список игр: /rpr_games")
+        return
+    backup = games.backup()
+    game["archived"] = True
+    message = f"Игра {game_title(game)} перенесена в архив."
+    left = None
+    if game_id == games.active:
+        left = await leave_game(games, game_id)
+        message += f" Начата игра {game_title(games.start())}."
+    if not await save_games(update, games, backup):
+        return
+    await carry_members(games, left)
+    await update.message.reply_text(message)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений из разных чатов.
+
+    Обновления одного чата выполняются строго по очереди (по блокировке на
+    effective_chat.id, asyncio.Lock пропускает ожидающих в порядке прихода),
+    а разные чаты - одновременно, не больше UPDATE_CONCURRENCY сразу. Место в
+    общем лимите занимается уже после блокировки чата, поэтому очередь одного
+    чата не мешает остальным.
+
+    queue_limit - размер семафора BaseUpdateProcessor: сколько обновлений
+    одновременно ждут своей очереди или выполняются. Это не обратное давление:
+    python-telegram-bot 20.7 все равно создает задачу на каждое полученное
+    обновление, лишние задачи просто ждут семафора.
+    """
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, queue_limit=UPDATE_QUEUE_LIMIT):
+        super().__init__(max(queue_limit, concurrency))
+        self._running = asyncio.Semaphore(concurrency)
+        self._locks = {}  # chat_id -> [блокировка, число ожидающих обновлений]
+
+    @staticmethod
+    def _key(update):
+        """Чат обновления; для обновлений без чата - пользователь."""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+        else:
+            await self._process_in_chat(key, coroutine)
+        if metrics.first_update is None:
+            metrics.first_update = time.perf_counter() - STARTUP_STARTED
+            logger.info(f"Первое обновление обработано через {metrics.first_update:.2f} с после запуска.")
+
+    async def _process_in_chat(self, key, coroutine):
+        """Обработка после предыдущих обновлений того же чата."""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def webhook_secret():
+    """Секрет webhook: из WEBHOOK_SECRET или постоянный, выведенный из токена бота."""
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+
+def make_http_app(application: Application, secret=None):
+    """HTTP-приложение: прием обновлений (если задан secret), проверка здоровья и метрики."""
+    import tornado.web
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            # Сравниваются байты: compare_digest не принимает строки с не-ASCII символами
+            if not hmac.compare_digest(token.encode(), secret.encode()):
+                raise tornado.web.HTTPError(403)
+            try:
+                update = Update.de_json(json.loads(self.request.body), application.bot)
+            except (ValueError, TypeError):
+                raise tornado.web.HTTPError(400)
+            await application.update_queue.put(update)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            if not application.running:
+                self.set_status(503)
+            self.write({"status": "ok" if application.running else "stopping"})
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(metrics.prometheus(runtime_metrics()))
+
+    routes = [(r"/healthz", HealthHandler), (r"/metrics", MetricsHandler)]
+    if secret:
+        routes.append((WEBHOOK_PATH, WebhookHandler))
+    return tornado.web.Application(routes)
+
+async def on_startup(application: Application):
+    """Запуск сервера метрик и прогрева кэша в режиме polling."""
+    await start_metrics_server(application)
+    warm_up_drive_client()
+    start_prefetch(application)
+
+def warm_up_drive_client():
+    """Импорт и сборка клиента Google Drive в фоне, пока бот уже принимает обновления."""
+    if STORAGE_BACKEND == "drive":
+        drive_executor.submit(get_gdrive_service)
+
+async def start_metrics_server(application: Application):
+    """Сервер /metrics и /healthz в режиме polling (если задан METRICS_PORT)."""
+    if METRICS_PORT:
+        make_http_app(application).listen(int(METRICS_PORT))
+        logger.info(f"Метрики доступны на порту {METRICS_PORT}.")
+
+async def run_webhook(application: Application):
+    """Работа через webhook на порту $PORT вместо long polling.
+
+    Webhook при остановке не снимается, поэтому обновления, пришедшие во время
+    перезапуска, Telegram доставит после него.
+    """
+    import tornado.httpserver
+
+    secret = webhook_secret()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    async with application:
+        await application.bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret,
+                                          allowed_updates=Update.ALL_TYPES, drop_pending_updates=False)
+        await application.start()
+        server = tornado.httpserver.HTTPServer(make_http_app(application, secret))
+        server.listen(PORT)
+        logger.info(f"Webhook-сервер запущен на порту {PORT}.")
+        warm_up_drive_client()
+        start_prefetch(application)
+        try:
+            await stop.wait()
+        finally:
+            server.stop()
+            await application.stop()
+            await on_shutdown(application)
+
+async def on_shutdown(application: Application):
+    """Сохранение всех отложенных изменений перед остановкой"""
+    prefetch = application.bot_data.pop("prefetch", None)
+    if prefetch:
+        prefetch.cancel()
+    await state_flusher.drain()
+    state_journal.close()
+    if update_recorder:
+        update_recorder.close()
+    drive_executor.shutdown(wait=True)
+
+async def toggle_live_leaderboard(update: Update, context: CallbackContext):
+    """Включение и выключение живой таблицы лидеров в чате"""
+    if not await is_authorized(update, context):
+        return
+
+    state = await active_state(update.effective_chat.id)
+    change_state(state, {"op": "set", "values": {"live_leaderboard": not state.live_leaderboard,
+                                                 "leaderboard_message_ids": []}})
+    if state.live_leaderboard:
+        await update.message.reply_text("Живая таблица лидеров включена: она будет обновляться в закрепленном сообщении.")
+        await live_leaderboard.refresh(state, context.bot)
+    else:
+        await update.message.reply_text("Живая таблица лидеров выключена.")
+
+def runtime_metrics():
+    """Показатели кэшей и клиента Google Drive для /metrics: тройки (имя, тип, значение)."""
+    return [
+        ("uptime_seconds", "gauge", round(time.time() - metrics.started)),
+        ("state_cache_size", "gauge", len(state_cache)),
+        ("state_cache_hits_total", "counter", state_cache.hits),
+        ("state_cache_misses_total", "counter", state_cache.misses),
+        ("drive_client_builds_total", "counter", drive_clients.builds),
+        ("drive_client_builds_avoided_total", "counter", drive_clients.builds_avoided),
+        ("startup_seconds", "gauge", round(startup_marks[-1][1] - STARTUP_STARTED, 3)),
+    ] + ([("startup_first_update_seconds", "gauge", round(metrics.first_update, 3))] if metrics.first_update is not None else [])
+
+async def show_stats(update: Update, context: CallbackContext):
+    """Сводка метрик: вызовы, ошибки и время обработчиков и запросов к API"""
+    if update.effective_user.id not in whitelist:
+        return
+
+    uptime = int(time.time() - metrics.started)
+    lines = [
+        f"📊 Статистика за {uptime // 3600} ч {uptime % 3600 // 60} мин",
+        f"Кэш чатов: {len(state_cache)} в памяти, попаданий {state_cache.hits}, промахов {state_cache.misses}",
+        f"Клиент Google Drive: создан {drive_clients.builds} раз, повторно использован {drive_clients.builds_avoided} раз",
+    ]
+    titles = {"handler": "Обработчики", "drive": "Google Диск", "telegram": "Bot API"}
+    series = metrics.snapshot()
+    for kind, title in titles.items():
+        rows = [(name, values) for (series_kind, name), values in series if series_kind == kind]
+        if not rows:
+            continue
+        lines.append("")
+        lines.append(f"{title} (вызовы / ошибки / p50 / p95 / p99, мс):")
+        for name, (count, errors, _, buckets) in rows:
+            p50, p95, p99 = (Metrics.quantile(buckets, q) * 1000 for q in (0.5, 0.95, 0.99))
+            lines.append(f"{name}: {count} / {errors} / {p50:.0f} / {p95:.0f} / {p99:.0f}")
+
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
+async def on_error(update: object, context: CallbackContext):
+    """Ошибки обработчиков; при сбое загрузки игры пользователь получает ответ, а не тишину"""
+    if isinstance(context.error, StateLoadError):
+        logger.warning(f"{context.error}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("Не удалось загрузить данные игры, попробуйте позже.")
+        return
+    logger.error("Ошибка при обработке обновления", exc_info=context.error)
+
+def build_application(token=TOKEN, request=None):
+    """Приложение со всеми обработчиками; request заменяет транспорт Bot API (replay.py)."""
     application = (
         Application.builder()
-        .token(TOKEN)
-        .connect_timeout(20)
-        .read_timeout(20)
+        .token(token)
+        .request(request or TimedRequest(connection_pool_size=256, connect_timeout=20, read_timeout=20))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(ChatOrderedUpdateProcessor())
         .build()
     )
 
+    # Запись обновлений для воспроизведения - до любой обработки
+    if update_recorder:
+        application.add_handler(TypeHandler(Update, record_update), group=-2)
+
+    # Права администраторов чатов отслеживаются по обновлениям ChatMember
+    application.add_handler(ChatMemberHandler(track_chat_admins, ChatMemberHandler.CHAT_MEMBER), group=-1)
+
+    # Кэш имен пополняется из всех сообщений до остальных обработчиков
+    application.add_handler(TypeHandler(Update, remember_users), group=-1)
+
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("rprun", start))
     application.add_handler(CommandHandler("rprlb", show_leaderboard))
     application.add_handler(CommandHandler("rpr_table", show_leaderboard))
+    application.add_handler(CommandHandler("rpr_rank", show_rank))
+    application.add_handler(CommandHandler("rpr_live", toggle_live_leaderboard))
 
     # Обработчики для добавления и удаления ответов
     application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^\+\+$|^плюс$|^/add$|^/plus$"), add_answer))
@@ -465,15 +3269,82 @@ def main():
     # Розыгрыш и управление
     application.add_handler(CommandHandler("rpr", roll_winner))
     application.add_handler(CommandHandler("rpr_modify", modify_roll))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^мрр$"), modify_roll))
+    application.add_handler(CommandHandler("rpr_weight", set_roll_weight))
+    application.add_handler(CommandHandler("rpr_autoexclude", toggle_exclude_winners))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^!?мрр(\s|$)"), modify_roll))
 
     # Управление белым списком
     application.add_handler(CommandHandler("rpr_wladd", add_to_whitelist))
     application.add_handler(CommandHandler("rpr_wldel", remove_from_whitelist))
     application.add_handler(CommandHandler("rpr_clearratio", clear_ratio))
 
-    # Запуск бота
-    application.run_polling(drop_pending_updates=True)
+    # Несколько игр в чате
+    application.add_handler(CommandHandler("rpr_newgame", new_game))
+    application.add_handler(CommandHandler("rpr_game", switch_game))
+    application.add_handler(CommandHandler("rpr_games", list_games))
+    application.add_handler(CommandHandler("rpr_archive", archive_game))
+    application.add_handler(CommandHandler("rpr_stats", show_stats))
+
+    application.add_error_handler(on_error)
+
+    # Замер времени всех зарегистрированных обработчиков
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.wrap_handler(handler.callback)
+    return application
+
+def startup_report():
+    """Время этапов запуска (--startup-report): импорт, клиент Google Drive, сборка Application и getMe.
+
+    Бот при этом не запускается; этапы после импорта выполняются так же, как
+    при обычном запуске и первом обращении к Google Диску.
+    """
+    marks = list(startup_marks)
+    google_preloaded = any(module in sys.modules for module in DRIVE_CLIENT_MODULES)
+
+    def phase(name, func, *args):
+        try:
+            result = func(*args)
+        except Exception as e:
+            name += f" (ошибка: {e})"
+            result = None
+        marks.append((name, time.perf_counter()))
+        return result
+
+    phase("импорт клиента Google Drive", lambda: [importlib.import_module(module) for module in DRIVE_CLIENT_MODULES])
+    if STORAGE_BACKEND == "drive" and GOOGLE_CREDENTIALS:
+        phase("создание клиента Google Drive", drive_clients.get)
+    application = phase("сборка Application", build_application, TOKEN or "0:startup-report")
+    if TOKEN and application:
+        async def initialize():
+            async with application:
+                pass
+        phase("инициализация Application (getMe)", asyncio.run, initialize())
+
+    previous = STARTUP_STARTED
+    print(f"{'Этап':<40} {'мс':>9} {'с начала, мс':>14}")
+    for name, moment in marks:
+        print(f"{name:<40} {(moment - previous) * 1000:>9.1f} {(moment - STARTUP_STARTED) * 1000:>14.1f}")
+        previous = moment
+    print(f"Модули Google загружены при импорте main.py: {'да' if google_preloaded else 'нет'}")
+
+def main():
+    """Основная функция запуска бота"""
+    if "--startup-report" in sys.argv[1:]:
+        startup_report()
+        return
+
+    logger.info("Запуск: " + ", ".join(f"{name} {(moment - previous) * 1000:.0f} мс" for (name, moment), (_, previous)
+                                       in zip(startup_marks, [("", STARTUP_STARTED)] + startup_marks)))
+    application = build_application()
+
+    # Запуск бота; обновления, пришедшие во время перезапуска, не отбрасываются
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
+
+startup_marks.append(("инициализация модуля", time.perf_counter()))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+"""Воспроизведение записанного потока обновлений для профилирования, без сети.
+
+Файл пишет сам бот при заданной переменной RECORD_UPDATES_FILE. Обновления
+проходят через настоящее Application со всеми обработчиками; состояние
+хранится во временной базе SQLite, Bot API заменен на FakeBotRequest.
+
+    python replay.py updates.jsonl                   # с исходной скоростью
+    python replay.py updates.jsonl --speed 10        # в 10 раз быстрее
+    python replay.py updates.jsonl --speed max --bot-latency 0.05 --output replay.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+# Хранилище и файлы бота подменяются до импорта: конфигурация читается при импорте
+WORK_DIR = tempfile.mkdtemp(prefix="replay-")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(WORK_DIR, "state.sqlite3")
+os.environ["JOURNAL_FILE"] = ""
+os.environ.pop("RECORD_UPDATES_FILE", None)
+os.environ.pop("METRICS_PORT", None)
+
+import main  # noqa: E402
+from fakes import FakeBotRequest  # noqa: E402
+from telegram import Update  # noqa: E402
+
+main.WHITELIST_FILE = os.path.join(WORK_DIR, "whitelist.json")
+main.FILE_IDS_FILE = os.path.join(WORK_DIR, "file_ids.json")
+
+
+def read_records(path):
+    """Записи файла по порядку."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(records, speed=None, bot_latency=0.0):
+    """Подача обновлений в Application; speed - ускорение или None (без пауз)."""
+    request = FakeBotRequest(bot_latency)
+    application = main.build_application(token="0:replay", request=request)
+    started = time.perf_counter()
+    async with application:
+        first = records[0]["ts"] if records else 0
+        tasks = []
+        for record in records:
+            if speed:
+                delay = (record["ts"] - first) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update = Update.de_json(record["update"], application.bot)
+            if record.get("admin") and update.effective_user:
+                main.whitelist.add(update.effective_user.id)
+            # Как при работе бота: через процессор обновлений, с параллельностью по чатам
+            processing = application.update_processor.process_update(update, application.process_update(update))
+            tasks.append(asyncio.ensure_future(processing))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        flush_started = time.perf_counter()
+        await main.state_flusher.drain()
+        flush = time.perf_counter() - flush_started
+    return elapsed, flush, request.calls
+
+
+def handler_report(elapsed):
+    """Вызовы, ошибки и задержки по обработчикам из метрик бота."""
+    rows = []
+    for (kind, name), (count, errors, total, buckets) in main.metrics.snapshot():
+        if kind != "handler":
+            continue
+        rows.append({
+            "handler": name,
+            "calls": count,
+            "errors": errors,
+            "per_s": round(count / elapsed, 1) if elapsed else 0,
+            "mean_ms": round(total / count * 1000, 2),
+            "p50_ms": round(main.Metrics.quantile(buckets, 0.5) * 1000, 2),
+            "p95_ms": round(main.Metrics.quantile(buckets, 0.95) * 1000, 2),
+            "p99_ms": round(main.Metrics.quantile(buckets, 0.99) * 1000, 2),
+        })
+    return rows
+
+
+def speed_value(value):
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть больше нуля или max")
+    return speed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений")
+    parser.add_argument("path", help="JSONL, записанный ботом (RECORD_UPDATES_FILE)")
+    parser.add_argument("--speed", type=speed_value, default=1.0,
+                        help="1 - исходная скорость, N - в N раз быстрее, max - без пауз")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="задержка вызова Bot API, секунд")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    records = read_records(args.path)
+    elapsed, flush, calls = asyncio.run(replay(records, args.speed, args.bot_latency))
+    rows = handler_report(elapsed)
+
+    print(f"Обновлений: {len(records)}, время: {elapsed:.2f} с, сохранение: {flush:.2f} с")
+    print(f"Вызовы Bot API: {', '.join(f'{name} {count}' for name, count in sorted(calls.items()))}")
+    columns = list(rows[0]) if rows else []
+    print("  ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print("  ".join(f"{str(row[column]):>16}" for column in columns))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"updates": len(records), "elapsed_s": round(elapsed, 3), "flush_s": round(flush, 3),
+                       "bot_calls": calls, "handlers": rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
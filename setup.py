@@ -6,6 +6,6 @@ setup(
     description='Telegram bot for rating and RnD',
     author='EDITORrc',
     author_email='aeditor.rc@gmail.com',
-    install_requires=['python-telegram-bot==20.7'],
+    install_requires=['python-telegram-bot[webhooks]==20.7'],
     python_requires='>=3.10',
 )
@@ -0,0 +1,39 @@
+"""Общие настройки тестов: бот импортируется без журнала и работает с заменителем Google Диска."""
+import os
+import sys
+
+# Конфигурация читается при импорте бота
+os.environ["JOURNAL_FILE"] = ""
+os.environ["FLUSH_DELAY"] = "0.01"
+os.environ["STORAGE_BACKEND"] = "drive"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import main  # noqa: E402
+from fakes import FakeDrive  # noqa: E402
+
+
+@pytest.fixture
+def drive(monkeypatch, tmp_path):
+    """Пустой Google Диск в памяти, чистый индекс файлов, кэш и отключенный журнал."""
+    drive = FakeDrive()
+    monkeypatch.setattr(main, "get_gdrive_service", lambda: drive)
+    monkeypatch.setattr(main, "FILE_IDS_FILE", str(tmp_path / "file_ids.json"))
+    monkeypatch.setattr(main, "file_ids", {})
+    monkeypatch.setattr(main, "missing_files", {})
+    monkeypatch.setattr(main, "state_store", main.DriveStateStore())
+    monkeypatch.setattr(main, "state_cache", main.ChatStateCache())
+    monkeypatch.setattr(main, "chat_games", main.ChatGamesCache())
+    monkeypatch.setattr(main, "state_journal", main.StateJournal(None))
+    return drive
+
+
+@pytest.fixture
+def sqlite_store(monkeypatch, tmp_path):
+    """Хранилище SQLite во временном файле вместо Google Диска."""
+    store = main.SqliteStateStore(str(tmp_path / "bot_state.sqlite3"))
+    monkeypatch.setattr(main, "state_store", store)
+    monkeypatch.setattr(main, "state_cache", main.ChatStateCache())
+    monkeypatch.setattr(main, "state_journal", main.StateJournal(None))
+    return store
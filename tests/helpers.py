@@ -0,0 +1,40 @@
+"""Общие шаги тестов хранения: операции игры и сравнение состояний."""
+import json
+
+
+def play(state, ops):
+    """Применение операций, как это делают обработчики (номер нового ответа - в операции)."""
+    for op in ops:
+        if op["op"] == "add":
+            op = dict(op, number=state.next_number)
+        assert state.apply(op)
+
+
+def sample_ops():
+    """25 ответов трех пользователей, удаление, исключение и веса."""
+    ops = [{"op": "add", "user": 100 + i % 3, "text": f"ответ {i}"} for i in range(25)]
+    ops += [
+        {"op": "remove", "number": 4},
+        {"op": "exclude", "user": 102},
+        {"op": "user_weight", "user": 101, "weight": 3},
+        {"op": "answer_weight", "number": 7, "weight": 0.5},
+        {"op": "members", "members": [[100, "alice", "Alice"]]},
+    ]
+    return ops
+
+
+def snapshot(state):
+    """Все, что видно пользователю игры."""
+    return {
+        "answers": dict(state.answers),
+        "user_answers": {user_id: sorted(answers) for user_id, answers in state.user_answers.items()},
+        "pool": {number: state.roll_pool.weight(number) for number in state.roll_pool},
+        # Очередность при равных баллах SQLite не хранит
+        "scores": sorted(state.leaderboard.items()),
+        "next_number": state.next_number,
+        "members": dict(state.members),
+    }
+
+
+def stored_json(drive, filename):
+    return next(json.loads(file["content"]) for file in drive.stored.values() if file["name"] == filename)
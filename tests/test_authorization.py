@@ -0,0 +1,97 @@
+"""Права на управление ботом: белый список и кэш администраторов чата."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError
+
+import main
+from fakes import FakeBot
+
+CHAT_ID = -100
+
+
+class AdminsBot(FakeBot):
+    """FakeBot с настраиваемым списком администраторов чата."""
+
+    def __init__(self, admins=(), error=None):
+        super().__init__()
+        self.admins = list(admins)
+        self.error = error
+        self.admin_requests = 0
+
+    async def get_chat_administrators(self, chat_id):
+        self.admin_requests += 1
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        return [SimpleNamespace(user=self.user(user_id), status="administrator") for user_id in self.admins]
+
+
+@pytest.fixture(autouse=True)
+def fresh_admins(monkeypatch):
+    monkeypatch.setattr(main, "chat_admins", main.ChatAdminCache(ttl=60))
+    monkeypatch.setattr(main, "whitelist", {1})
+    monkeypatch.setattr(main, "CHAT_ADMINS_AUTHORIZED", True)
+
+
+def authorized(bot, user_id, chat_type="group"):
+    update, context = bot.update(CHAT_ID, user_id, "/rpr")
+    update.effective_chat.type = chat_type
+    return asyncio.run(main.is_authorized(update, context))
+
+
+def test_whitelist_and_admins():
+    bot = AdminsBot(admins=[2])
+    assert authorized(bot, 1)
+    assert bot.admin_requests == 0
+    assert authorized(bot, 2)
+    assert not authorized(bot, 3)
+    # Список администраторов запрошен один раз и дальше берется из кэша
+    assert bot.admin_requests == 1
+
+
+def test_admins_are_not_checked_in_private_chats_or_when_disabled(monkeypatch):
+    bot = AdminsBot(admins=[2])
+    assert not authorized(bot, 2, chat_type="private")
+    monkeypatch.setattr(main, "CHAT_ADMINS_AUTHORIZED", False)
+    assert not authorized(bot, 2)
+    assert bot.admin_requests == 0
+
+
+def test_anonymous_admin_writes_as_the_chat():
+    bot = AdminsBot()
+    update, context = bot.update(CHAT_ID, 5, "/rpr")
+    update.effective_message.sender_chat = SimpleNamespace(id=CHAT_ID)
+    assert asyncio.run(main.is_authorized(update, context))
+
+
+def test_failed_admin_request_denies_and_is_not_cached():
+    bot = AdminsBot(admins=[2], error=NetworkError("timeout"))
+    assert not authorized(bot, 2)
+    bot.error = None
+    assert authorized(bot, 2)
+    assert bot.admin_requests == 2
+
+
+def test_concurrent_checks_share_one_request():
+    bot = AdminsBot(admins=[2])
+
+    async def run():
+        return await asyncio.gather(*(main.chat_admins.is_admin(bot, CHAT_ID, user_id) for user_id in (2, 3, 2)))
+
+    assert asyncio.run(run()) == [True, False, True]
+    assert bot.admin_requests == 1
+
+
+def test_member_updates_and_ttl():
+    bot = AdminsBot(admins=[2])
+    assert authorized(bot, 2)
+    main.chat_admins.member_updated(CHAT_ID, 2, "member")
+    main.chat_admins.member_updated(CHAT_ID, 3, "administrator")
+    assert not authorized(bot, 2)
+    assert authorized(bot, 3)
+    assert bot.admin_requests == 1
+    main.chat_admins.ttl = 0
+    assert authorized(bot, 2)
+    assert bot.admin_requests == 2
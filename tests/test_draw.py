@@ -0,0 +1,126 @@
+"""Розыгрыш: множества с весами, двухуровневый пул и /rpr_weight."""
+import asyncio
+import random
+from collections import Counter
+
+import pytest
+
+import main
+from fakes import FakeBot
+from main import ChatState, RollPool, WeightedSet
+
+
+def test_weighted_set_add_discard():
+    numbers = WeightedSet([1, 2, 3])
+    numbers.add(4, 3)
+    assert numbers.total() == 6
+    assert numbers.discard(2)
+    assert not numbers.discard(2)
+    assert sorted(numbers) == [1, 3, 4]
+    assert numbers.total() == 5
+    numbers.set_weight(4, 1)
+    assert numbers.weight(4) == 1
+    assert numbers.total() == 3
+
+
+def test_weighted_set_choice_follows_weights():
+    random.seed(1)
+    numbers = WeightedSet([1, 2, 3])
+    numbers.set_weight(1, 0)
+    numbers.set_weight(3, 3)
+    counts = Counter(numbers.choice() for _ in range(4000))
+    assert counts[1] == 0
+    assert counts[3] / counts[2] == pytest.approx(3, rel=0.15)
+
+
+def test_weighted_set_empty_choice():
+    numbers = WeightedSet([1])
+    numbers.set_weight(1, 0)
+    assert numbers.choice() is None
+    numbers.clear()
+    assert numbers.choice() is None
+
+
+def test_roll_pool_groups_by_author():
+    pool = RollPool()
+    pool.add(1, group=10)
+    pool.add(2, weight=2, group=10)
+    pool.add(3)
+    assert len(pool) == 3
+    assert pool.weight(2) == 2
+    assert pool.discard(3)
+    assert 3 not in pool
+    pool.discard(1)
+    pool.discard(2)
+    assert len(pool) == 0
+    assert pool.choice() is None
+    assert pool.draw(3) == []
+
+
+def test_roll_pool_choice_follows_answer_weights():
+    # Вероятность ответа не зависит от того, как ответы распределены по авторам
+    random.seed(2)
+    pool = RollPool()
+    pool.add(1, group="a")
+    pool.add(2, group="a")
+    pool.add(3, weight=2, group="b")
+    counts = Counter(pool.choice() for _ in range(8000))
+    assert counts[1] / 8000 == pytest.approx(0.25, abs=0.03)
+    assert counts[3] / 8000 == pytest.approx(0.5, abs=0.03)
+
+
+def test_roll_pool_draw_distinct_authors():
+    random.seed(3)
+    pool = RollPool()
+    for number in range(1, 101):
+        pool.add(number, group=number % 3)
+    before = [pool.weight(number) for number in range(1, 101)]
+    for _ in range(50):
+        numbers = pool.draw(5)
+        assert len(numbers) == 3
+        assert len({number % 3 for number in numbers}) == 3
+    assert len(pool.draw(1)) == 1
+    # Розыгрыш не меняет пул
+    assert [pool.weight(number) for number in range(1, 101)] == before
+    assert Counter(pool.draw(2)[0] % 3 for _ in range(3000)).keys() == {0, 1, 2}
+
+
+def test_chat_state_draw_returns_owners():
+    state = ChatState(1)
+    state.add_answer(7, "a")
+    state.add_answer(7, "b")
+    state.add_answer(8, "c")
+    winners = state.draw(2)
+    assert sorted(user_id for _, user_id in winners) == [7, 8]
+    assert all(state.owners[number] == user_id for number, user_id in winners)
+    state.exclude_user(7)
+    assert state.draw(2) == [(3, 8)]
+
+
+@pytest.mark.parametrize("weight", ["nan", "inf", "-1", "abc"])
+def test_roll_weight_rejects_invalid_weights(drive, monkeypatch, weight):
+    monkeypatch.setattr(main, "whitelist", {1})
+    bot = FakeBot()
+
+    async def run():
+        update, context = bot.update(-100, 1, f"/rpr_weight 5 {weight}", args=["5", weight])
+        await main.set_roll_weight(update, context)
+        return await main.active_state(-100)
+
+    state = asyncio.run(run())
+    assert state.user_weights == {}
+    assert not state.dirty
+
+
+def test_roll_weight_sets_user_weight(drive, monkeypatch):
+    monkeypatch.setattr(main, "whitelist", {1})
+    bot = FakeBot()
+
+    async def run():
+        update, context = bot.update(-100, 1, "/rpr_weight 5 2.5", args=["5", "2.5"])
+        await main.set_roll_weight(update, context)
+        state = await main.active_state(-100)
+        await main.state_flusher.drain()
+        return state
+
+    assert asyncio.run(run()).user_weights == {5: 2.5}
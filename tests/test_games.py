@@ -0,0 +1,96 @@
+"""Несколько игр в чате: /rpr_newgame, /rpr_game, /rpr_archive."""
+import asyncio
+
+import pytest
+
+import main
+from fakes import FakeBot
+
+ADMIN_ID = 1
+CHAT_ID = -100
+
+
+class RepliesBot(FakeBot):
+    """FakeBot, который запоминает тексты отправленных сообщений."""
+
+    def __init__(self):
+        super().__init__()
+        self.replies = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.replies.append(text)
+        return await super().send_message(chat_id, text, **kwargs)
+
+
+@pytest.fixture
+def bot(drive, monkeypatch):
+    monkeypatch.setattr(main, "whitelist", {ADMIN_ID})
+    monkeypatch.setattr(main, "name_resolver", main.NameResolver())
+    return RepliesBot()
+
+
+async def command(bot, handler, text, *args):
+    update, context = bot.update(CHAT_ID, ADMIN_ID, text, args=args)
+    await handler(update, context)
+    return bot.replies[-1]
+
+
+async def plus(bot, user_id, text):
+    update, context = bot.update(CHAT_ID, ADMIN_ID, "++", reply_user_id=user_id, reply_text=text)
+    await main.add_answer(update, context)
+
+
+def restart():
+    """Новый процесс: пустые кэши, те же данные в хранилище."""
+    main.state_cache = main.ChatStateCache()
+    main.chat_games = main.ChatGamesCache()
+
+
+def test_games_are_separate_and_survive_restart(bot):
+    async def run():
+        await plus(bot, 10, "первая")
+        assert "Начата игра №1 «Финал»" in await command(bot, main.new_game, "/rpr_newgame", "Финал")
+        await plus(bot, 11, "вторая")
+        assert (await main.active_state(CHAT_ID)).leaderboard.top() == [(11, 1)]
+        await main.state_flusher.drain()
+
+        restart()
+        assert (await main.chat_games.get(CHAT_ID)).active == "1"
+        assert "Активна игра «Основная игра»" in await command(bot, main.switch_game, "/rpr_game", "default")
+        assert (await main.active_state(CHAT_ID)).leaderboard.top() == [(10, 1)]
+
+        assert "Начата игра №2" in await command(bot, main.archive_game, "/rpr_archive")
+        games = await main.chat_games.get(CHAT_ID)
+        assert games.active == "2"
+        assert games.games["default"]["archived"]
+        await main.state_flusher.drain()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("handler, text, args", [
+    (main.new_game, "/rpr_newgame", ()),
+    (main.switch_game, "/rpr_game", ("1",)),
+    (main.archive_game, "/rpr_archive", ()),
+])
+def test_failed_save_rolls_back_game_list(bot, drive, handler, text, args):
+    async def run():
+        await plus(bot, 10, "первая")
+        await command(bot, main.new_game, "/rpr_newgame")
+        await command(bot, main.switch_game, "/rpr_game", "default")
+        await main.state_flusher.drain()
+        games = await main.chat_games.get(CHAT_ID)
+        before = games.backup()
+
+        drive.fail("update", times=100)
+        assert await command(bot, handler, text, *args) == "Не удалось сохранить список игр, попробуйте позже."
+        assert games.backup() == before
+        drive.failures.clear()
+
+        # В памяти и в хранилище - прежняя активная игра с ее ответами
+        assert (await main.active_state(CHAT_ID)).leaderboard.top() == [(10, 1)]
+        await main.state_flusher.drain()
+        restart()
+        assert (await main.chat_games.get(CHAT_ID)).to_dict() == before
+
+    asyncio.run(run())
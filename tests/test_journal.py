@@ -0,0 +1,65 @@
+"""Локальный журнал операций: восстановление после сбоя и перезапись."""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import main
+from helpers import play, sample_ops, snapshot
+
+
+def test_journal_replays_after_crash(drive, monkeypatch, tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = main.StateJournal(path)
+    monkeypatch.setattr(main, "state_journal", journal)
+    state = main.ChatState(1)
+    ops = sample_ops()
+    play(state, ops[:10])
+    asyncio.run(main.save_bot_state(state))
+    for op in ops[10:]:
+        play(state, [op])
+        journal.append(state, state.pending_ops[-1])
+    expected = snapshot(state)
+    # Сбой: снимок с остальными операциями не сохранен, последняя строка журнала недописана
+    journal.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"chat": 1, "game": "default", "seq": 99, "op": "ad')
+
+    journal = main.StateJournal(path)
+    monkeypatch.setattr(main, "state_journal", journal)
+    assert journal.pending(1, "default")
+    restored = main.load_bot_state(1)
+    assert snapshot(restored) == expected
+    assert restored.revision == len(ops)
+    assert restored.dirty
+
+    asyncio.run(main.save_bot_state(restored))
+    assert not journal.pending(1, "default")
+    reloaded = main.load_bot_state(1)
+    asyncio.run(main.ensure_answers(reloaded))
+    assert snapshot(reloaded) == expected
+    journal.close()
+
+
+def test_journal_is_compacted_after_snapshots(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "JOURNAL_COMPACT_LINES", 3)
+    path = str(tmp_path / "journal.jsonl")
+    journal = main.StateJournal(path)
+    state = main.ChatState(1)
+    for op in sample_ops()[:5]:
+        play(state, [op])
+        journal.append(state, state.pending_ops[-1])
+    journal.snapshot_saved(1, "default", 4)
+    journal.close()
+    # В файле осталась только операция, которой нет в снимке
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["seq"] for line in f] == [5]
+
+
+def test_journal_is_off_by_default(tmp_path):
+    env = {key: value for key, value in os.environ.items() if key != "JOURNAL_FILE"}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys; sys.path.insert(0, sys.argv[1]); import main; assert not main.state_journal.enabled"
+    subprocess.run([sys.executable, "-c", code, root], cwd=tmp_path, env=env, check=True, capture_output=True)
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,52 @@
+"""Дерево Фенвика и таблица лидеров с top-K и местами."""
+from main import FenwickTree, Leaderboard
+
+
+def test_fenwick_prefix_sums_match_list():
+    values = [3, 0, 5, 1, 0, 2, 7]
+    tree = FenwickTree(values)
+    for end in range(len(values) + 2):
+        assert tree.prefix_sum(end) == sum(values[:end])
+    tree.add(2, -4)
+    values[2] -= 4
+    assert [tree.prefix_sum(end) for end in range(len(values) + 1)] == [sum(values[:end]) for end in range(len(values) + 1)]
+    assert tree.total() == sum(values)
+
+
+def test_fenwick_grows_on_add():
+    tree = FenwickTree([1, 1])
+    tree.add(9, 5)
+    assert tree.get(9) == 5
+    assert tree.get(100) == 0
+    assert tree.total() == 7
+
+
+def test_fenwick_find():
+    tree = FenwickTree([2, 0, 3, 1])
+    # Префиксные суммы 2, 2, 5, 6: value попадает в первый элемент, где сумма его превышает
+    assert [tree.find(value) for value in (0, 1.9, 2, 4.5, 5, 5.9)] == [0, 0, 2, 2, 3, 3]
+
+
+def test_leaderboard_top_and_rank():
+    leaderboard = Leaderboard()
+    for user_id, score in ((1, 2), (2, 5), (3, 2), (4, 1)):
+        leaderboard.add(user_id, score)
+    # При равных баллах выше тот, кто набрал их раньше
+    assert leaderboard.top() == [(2, 5), (1, 2), (3, 2), (4, 1)]
+    assert leaderboard.top(2) == [(2, 5), (1, 2)]
+    assert leaderboard.rank(2) == 1
+    assert leaderboard.rank(4) == 4
+    assert leaderboard.rank(99) is None
+
+
+def test_leaderboard_score_changes_and_removal():
+    leaderboard = Leaderboard.from_user_answers({1: [1, 2], 2: [3]})
+    leaderboard.add(2, 2)
+    assert leaderboard.score(2) == 3
+    assert leaderboard.top(1) == [(2, 3)]
+    leaderboard.add(1, -2)
+    assert leaderboard.score(1) == 0
+    assert len(leaderboard) == 1
+    leaderboard.remove_user(2)
+    leaderboard.remove_user(2)
+    assert leaderboard.top() == []
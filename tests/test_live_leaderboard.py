@@ -0,0 +1,107 @@
+"""Живая таблица лидеров и разбиение длинных сообщений."""
+import asyncio
+
+import main
+from fakes import FakeBot
+
+
+class CountingBot(FakeBot):
+    """FakeBot, который запоминает правки и отправки по методам."""
+
+    def __init__(self):
+        super().__init__()
+        self.edits = []
+        self.sends = []
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits.append(message_id)
+        return await super().edit_message_text(text, chat_id, message_id, **kwargs)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sends.append(text)
+        return await super().send_message(chat_id, text, **kwargs)
+
+
+def add_answers(state, count, users=5, text="ответ"):
+    for i in range(count):
+        state.apply({"op": "add", "user": i % users, "text": f"{text} {i}", "number": state.next_number})
+
+
+def test_split_message_respects_limit_and_lines():
+    text = "\n".join(f"строка {i}" for i in range(100))
+    chunks = main.split_message(text, limit=50)
+    assert all(main._telegram_length(chunk) <= 50 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_split_message_cuts_long_lines_by_utf16_length():
+    # Эмодзи занимает две единицы UTF-16
+    chunks = main.split_message("😀" * 30, limit=10)
+    assert all(main._telegram_length(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks) == "😀" * 30
+    assert main.split_message("") == [""]
+
+
+def test_refresh_edits_only_changed_messages(drive, monkeypatch):
+    monkeypatch.setattr(main, "name_resolver", main.NameResolver())
+    monkeypatch.setattr(main, "PLUS_FULL_LEADERBOARD_MAX", 10000)
+    bot = CountingBot()
+    live = main.LiveLeaderboard(delay=0)
+
+    async def run():
+        state = await main.state_cache.get(1)
+        # Длинные ответы: таблица занимает несколько сообщений
+        add_answers(state, 60, text="x" * 200)
+        await live.refresh(state, bot)
+        assert len(bot.sends) == len(state.leaderboard_message_ids) > 2
+        assert not bot.edits
+
+        await live.refresh(state, bot)
+        assert not bot.edits
+
+        # Новый ответ меняет последнее сообщение (список ответов) и сводку
+        add_answers(state, 1)
+        await live.refresh(state, bot)
+        assert bot.edits == state.leaderboard_message_ids[-1:]
+        await main.state_flusher.drain()
+
+    asyncio.run(run())
+
+
+def test_large_game_shows_top_places(drive, monkeypatch):
+    monkeypatch.setattr(main, "name_resolver", main.NameResolver())
+    monkeypatch.setattr(main, "PLUS_FULL_LEADERBOARD_MAX", 20)
+    bot = CountingBot()
+    live = main.LiveLeaderboard(delay=0)
+
+    async def run():
+        state = await main.state_cache.get(1)
+        add_answers(state, 30, users=15)
+        await live.refresh(state, bot)
+        text, = bot.sends
+        assert f"Топ-{main.PLUS_TOP_PLACES}" in text
+        assert "ответ" not in text
+        await main.state_flusher.drain()
+
+    asyncio.run(run())
+
+
+def test_timer_skips_unloaded_game(drive, monkeypatch):
+    monkeypatch.setattr(main, "name_resolver", main.NameResolver())
+    bot = CountingBot()
+    live = main.LiveLeaderboard(delay=0.01)
+
+    async def run():
+        state = await main.state_cache.get(1)
+        state.live_leaderboard = True
+        add_answers(state, 3)
+        live.schedule(state, bot)
+        await main.state_cache.unload(1, "default")
+        revision = state.revision
+        await asyncio.sleep(0.05)
+        # Выгруженный объект не меняется и не сохраняется заново
+        assert not bot.sends
+        assert state.revision == revision
+        assert not live._timers
+
+    asyncio.run(run())
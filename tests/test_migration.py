@@ -0,0 +1,74 @@
+"""Перевод файлов состояния версий 1 и 2 в текущую схему."""
+import asyncio
+
+import pytest
+
+import main
+from helpers import snapshot, stored_json
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_old_state_files_are_migrated(drive, version):
+    if version == 1:
+        # В версии 1 ответы хранились дважды, ключи user_answers - строки;
+        # ответ исключенного пользователя остался только в answer_list
+        data = {
+            "answer_list": [{"number": 1, "text": "a"}, {"number": 2, "text": "b"}, {"number": 3, "text": "c"}],
+            "user_answers": {"100": [{"number": 1, "text": "a"}], "101": [{"number": 2, "text": "b"}]},
+            "roll_pool": [1, 2],
+            "user_weights": [[101, 2]],
+        }
+    else:
+        data = {
+            "version": 2,
+            "answers": [[1, 100, "a"], [2, 101, "b"], [3, None, "c"]],
+            "next_number": 4,
+            "roll_pool": [1, 2],
+            "user_weights": [[101, 2]],
+        }
+    assert main.state_store._upload(main.get_filename(1, "default"), data)
+
+    state = main.load_bot_state(1)
+    assert {number: answer["text"] for number, answer in state.answers.items()} == {1: "a", 2: "b", 3: "c"}
+    assert state.owners == {1: 100, 2: 101, 3: None}
+    assert state.leaderboard.top() == [(100, 1), (101, 1)]
+    assert state.roll_pool.weight(2) == 2
+    assert state.next_number == 4
+
+    # Старый файл переписывается манифестом и сегментами при первом сохранении
+    state.revision += 1
+    asyncio.run(main.save_bot_state(state))
+    assert stored_json(drive, main.get_filename(1, "default"))["version"] == main.MANIFEST_VERSION
+    reloaded = main.load_bot_state(1)
+    asyncio.run(main.ensure_answers(reloaded))
+    assert snapshot(reloaded) == snapshot(state)
+
+
+def test_v1_duplicate_numbers_are_renumbered(drive):
+    # Версия 1 после ++, ++, ++, /minus 2, ++: последний ответ получил номер len(answer_list) + 1 = 3
+    data = {
+        "answer_list": [{"number": 1, "text": "a"}, {"number": 3, "text": "c"}, {"number": 3, "text": "d"}],
+        "user_answers": {"10": [{"number": 1, "text": "a"}, {"number": 3, "text": "c"}],
+                         "11": [{"number": 3, "text": "d"}]},
+        "roll_pool": [1, 3, 3],
+    }
+    assert main.state_store._upload(main.get_filename(1, "default"), data)
+
+    state = main.load_bot_state(1)
+    assert {number: (state.owners[number], answer["text"]) for number, answer in state.answers.items()} == {
+        1: (10, "a"), 3: (10, "c"), 4: (11, "d")}
+    assert state.leaderboard.top() == [(10, 2), (11, 1)]
+    assert sorted(state.roll_pool) == [1, 3, 4]
+    assert state.next_number == 5
+
+
+def test_v1_pool_duplicates_follow_excluded_answers():
+    # Пользователь 11 исключен: его ответ №3 остался только в answer_list, один из повторов убран из roll_pool
+    migrated = main.migrate_state_v1({
+        "answer_list": [{"number": 1, "text": "a"}, {"number": 3, "text": "c"}, {"number": 3, "text": "d"}],
+        "user_answers": {"10": [{"number": 1, "text": "a"}, {"number": 3, "text": "c"}]},
+        "roll_pool": [1, 3, 7],
+    })
+    assert migrated["answers"] == [[1, 10, "a"], [3, 10, "c"], [4, None, "d"]]
+    assert migrated["roll_pool"] == [1, 3]
+    assert migrated["next_number"] == 5
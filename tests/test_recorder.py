@@ -0,0 +1,87 @@
+"""Обезличивание записываемых обновлений (UpdateRecorder)."""
+import json
+
+import pytest
+from telegram import Update
+
+import main
+
+USER_ID = 777888
+CHAT_ID = -1001234567890
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    recorder = main.UpdateRecorder(str(tmp_path / "updates.jsonl"), "salt")
+    yield recorder
+    recorder.close()
+
+
+def message_update(text, user_id=USER_ID, **extra):
+    return Update.de_json({
+        "update_id": 1,
+        "message": {
+            "message_id": 5, "date": 1, "text": text,
+            "chat": {"id": CHAT_ID, "type": "supergroup", "title": "Секретный чат"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Иван", "username": "ivan"},
+            **extra,
+        },
+    }, None)
+
+
+def recorded_lines(recorder):
+    with open(recorder.path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("/rpr_modify 777888", "/rpr_modify {id}"),
+    ("/rpr_modify@rplusr_bot 777888", "/rpr_modify@rplusr_bot {id}"),
+    ("мрр 777888", "мрр {id}"),
+    ("!мрр  777888", "!мрр  {id}"),
+    ("/rpr_weight 777888 2", "/rpr_weight {id} 2"),
+    ("/rpr_wladd 777888", "/rpr_wladd {id}"),
+    ("/rpr_wldel 777888", "/rpr_wldel {id}"),
+    # Номера ответов и веса - не ID
+    ("/rpr_weight 2", "/rpr_weight 2"),
+    ("/rpr_weight #777888 2", "/rpr_weight #777888 2"),
+    ("/minus 3", "/minus 3"),
+    ("/rpr 2", "/rpr 2"),
+])
+def test_user_ids_in_commands_are_pseudonymized(recorder, text, expected):
+    assert recorder.anonymize_text(text) == expected.format(id=recorder.pseudonym_id(USER_ID))
+
+
+def test_mentions_and_other_text(recorder):
+    assert recorder.anonymize_text("мрр @ivan") == "мрр @" + recorder.pseudonym_text("ivan")
+    assert recorder.anonymize_text("Иван, мой id 777888") == "x" * 19
+
+
+def test_recorded_update_has_no_personal_data(recorder):
+    update = message_update("/rpr_modify 777888", contact={"phone_number": "+79990001122", "first_name": "Иван"},
+                            reply_to_message={"message_id": 4, "date": 1, "caption": "фото Ивана",
+                                              "chat": {"id": CHAT_ID, "type": "supergroup"},
+                                              "from": {"id": 555, "is_bot": False, "first_name": "Петр"}})
+    recorder.record(update, admin=True)
+    line, = recorded_lines(recorder)
+    raw = json.dumps(line, ensure_ascii=False)
+    for secret in ("777888", "555", "1234567890", "Иван", "ivan", "Петр", "Секретный", "7999", "фото"):
+        assert secret not in raw
+    message = line["update"]["message"]
+    assert "contact" not in message
+    # Команда обращается к тому же псевдониму, что и отправитель: replay исключит того же участника
+    assert message["text"] == f"/rpr_modify {message['from']['id']}"
+    assert message["chat"]["id"] < 0
+    assert len(message["from"]["first_name"]) == len("Иван")
+    # Запись снова разбирается в Update
+    assert Update.de_json(line["update"], None).message.reply_to_message.from_user.id == recorder.pseudonym_id(555)
+
+
+def test_pseudonyms_are_stable(recorder, tmp_path):
+    other = main.UpdateRecorder(str(tmp_path / "other.jsonl"), "salt")
+    try:
+        assert other.pseudonym_id(USER_ID) == recorder.pseudonym_id(USER_ID)
+    finally:
+        other.close()
+    assert recorder.pseudonym_id(USER_ID) != USER_ID
+    assert recorder.pseudonym_id(CHAT_ID) < 0
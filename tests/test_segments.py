@@ -0,0 +1,44 @@
+"""Сегменты ответов на Google Диске (заменитель из fakes.py): ленивая загрузка и запись только измененных."""
+import asyncio
+
+import main
+from helpers import play, sample_ops, snapshot, stored_json
+
+
+def test_drive_roundtrip_loads_segments_lazily(drive, monkeypatch):
+    monkeypatch.setattr(main, "ANSWER_SEGMENT_SIZE", 10)
+    state = main.ChatState(1, "1")
+    play(state, sample_ops())
+    expected = snapshot(state)
+    asyncio.run(main.save_bot_state(state))
+    assert not state.dirty
+    assert stored_json(drive, main.get_filename(1, "1"))["version"] == main.MANIFEST_VERSION
+
+    async def reload():
+        loaded = await main.ChatStateCache().get(1, "1")
+        # Манифест дает таблицу лидеров и число ответов без загрузки сегментов
+        assert loaded.missing_segments == {0, 1, 2}
+        assert loaded.answer_count == 24
+        assert sorted(loaded.leaderboard.items()) == expected["scores"]
+        assert await main.ensure_answers(loaded, [1])
+        assert loaded.missing_segments == {0, 2}
+        assert await main.ensure_answers(loaded)
+        return loaded
+
+    loaded = asyncio.run(reload())
+    assert snapshot(loaded) == expected
+    assert list(loaded.answers) == sorted(loaded.answers)
+
+
+def test_drive_saves_only_changed_segments(drive, monkeypatch):
+    monkeypatch.setattr(main, "ANSWER_SEGMENT_SIZE", 10)
+    state = main.ChatState(1)
+    play(state, sample_ops())
+    asyncio.run(main.save_bot_state(state))
+    segment = main.get_segment_filename(1, "default", 2)
+    modified = {file["name"]: file["modified"] for file in drive.stored.values()}
+    play(state, [{"op": "remove", "number": 22}])
+    asyncio.run(main.save_bot_state(state))
+    changed = {file["name"] for file in drive.stored.values() if file["modified"] != modified[file["name"]]}
+    assert changed == {main.get_filename(1, "default"), segment}
+    assert [row[0] for row in stored_json(drive, segment)] == [21, 23, 24, 25]
@@ -0,0 +1,45 @@
+"""Хранилище SQLite (STORAGE_BACKEND=sqlite)."""
+import asyncio
+
+import main
+from helpers import play, sample_ops, snapshot
+
+
+def test_sqlite_roundtrip(sqlite_store):
+    state = main.ChatState(1)
+    play(state, sample_ops())
+    expected = snapshot(state)
+    asyncio.run(main.save_bot_state(state))
+    assert not state.dirty
+    assert not state.pending_ops
+
+    loaded = main.load_bot_state(1)
+    assert not loaded.missing_segments
+    assert snapshot(loaded) == expected
+
+    play(loaded, [{"op": "clear"}, {"op": "add", "user": 5, "text": "заново"}])
+    asyncio.run(main.save_bot_state(loaded))
+    assert snapshot(main.load_bot_state(1)) == snapshot(loaded)
+    assert sqlite_store.list() == [(1, "default")]
+
+
+def test_sqlite_delete_removes_only_that_game(sqlite_store):
+    for game_number in ("default", "1"):
+        state = main.ChatState(1, game_number)
+        play(state, sample_ops())
+        asyncio.run(main.save_bot_state(state))
+    assert sqlite_store.delete(1, "default")
+    assert sqlite_store.load(1, "default") == {}
+    assert sqlite_store.list() == [(1, "1")]
+    assert len(sqlite_store.load(1, "1")["answers"]) == 24
+
+
+def test_sqlite_list_recent_orders_by_update_time(sqlite_store):
+    for game_number in ("1", "2", "3"):
+        state = main.ChatState(1, game_number)
+        play(state, sample_ops()[:1])
+        asyncio.run(main.save_bot_state(state))
+    state = main.load_bot_state(1, "1")
+    play(state, sample_ops()[1:2])
+    asyncio.run(main.save_bot_state(state))
+    assert sqlite_store.list_recent(2) == [(1, "1"), (1, "3")]
@@ -0,0 +1,69 @@
+"""Кэш состояний: ошибка хранилища не превращается в пустую игру и не теряет изменения."""
+import asyncio
+
+import pytest
+
+import main
+from helpers import play, sample_ops, snapshot
+
+
+def test_drive_error_is_not_cached_as_empty_game(drive):
+    state = main.ChatState(1)
+    play(state, sample_ops())
+    expected = snapshot(state)
+    asyncio.run(main.save_bot_state(state))
+
+    cache = main.ChatStateCache()
+    drive.fail("get_media", status=503)
+    with pytest.raises(main.StateLoadError):
+        asyncio.run(cache.get(1))
+    assert len(cache) == 0
+    assert cache.peek(1, "default") is None
+
+    async def reload():
+        loaded = await cache.get(1)
+        await main.ensure_answers(loaded)
+        return loaded
+
+    assert snapshot(asyncio.run(reload())) == expected
+
+
+def test_failed_write_back_keeps_state_in_memory(drive):
+    async def run():
+        cache = main.ChatStateCache()
+        state = await cache.get(1)
+        play(state, sample_ops())
+        expected = snapshot(state)
+        drive.fail("create", times=100)
+        drive.fail("update", times=100)
+        assert not await main.save_bot_state(state)
+
+        # Ни выгрузка, ни вытеснение не теряют несохраненную игру
+        assert await cache.unload(1, "default") is state
+        assert cache.peek(1, "default") is state
+        cache.ttl = 0
+        await cache.evict()
+        assert cache.peek(1, "default") is state
+        assert state.dirty
+
+        drive.failures.clear()
+        await cache.evict()
+        assert cache.peek(1, "default") is None
+        assert not state.dirty
+        return expected
+
+    expected = asyncio.run(run())
+    reloaded = main.load_bot_state(1)
+    asyncio.run(main.ensure_answers(reloaded))
+    assert snapshot(reloaded) == expected
+
+
+def test_drive_list_error_does_not_create_duplicate(drive):
+    drive.fail("list", status=500)
+    with pytest.raises(main.StateLoadError):
+        main.load_bot_state(1)
+    assert not drive.stored
+    # Настоящая новая игра - пустой файл, из которого строится пустое состояние
+    state = main.load_bot_state(1)
+    assert not state.answers
+    assert [file["name"] for file in drive.stored.values()] == [main.get_filename(1, "default")]
@@ -0,0 +1,70 @@
+"""Порядок обработки обновлений (ChatOrderedUpdateProcessor)."""
+import asyncio
+
+from telegram import Update
+
+import main
+
+
+def message_update(update_id, chat_id, user_id=1):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 1, "text": "++",
+                    "chat": {"id": chat_id, "type": "group"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "User"}},
+    }, None)
+
+
+def test_updates_of_one_chat_run_in_order_and_chats_in_parallel():
+    log = []
+
+    async def handle(name, delay):
+        log.append(("start", name))
+        await asyncio.sleep(delay)
+        log.append(("end", name))
+
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=4)
+        # Первое обновление чата 1 медленное: второе ждет его, а чат 2 - нет
+        updates = [(message_update(1, 1), handle("a1", 0.05)),
+                   (message_update(2, 1), handle("a2", 0)),
+                   (message_update(3, 2), handle("b1", 0))]
+        await asyncio.gather(*(processor.process_update(update, coroutine) for update, coroutine in updates))
+        assert not processor._locks
+
+    asyncio.run(run())
+    assert log.index(("end", "a1")) < log.index(("start", "a2"))
+    assert log.index(("end", "b1")) < log.index(("end", "a1"))
+
+
+def test_concurrency_limit_across_chats():
+    running = 0
+    peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=3)
+        await asyncio.gather(*(processor.process_update(message_update(i, -i), handle()) for i in range(1, 11)))
+
+    asyncio.run(run())
+    assert peak == 3
+
+
+def test_updates_without_chat_are_processed():
+    done = []
+
+    async def handle():
+        done.append(True)
+
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=2)
+        await processor.process_update({"not": "an update"}, handle())
+
+    asyncio.run(run())
+    assert done == [True]
@@ -0,0 +1,77 @@
+"""HTTP-сервер режима webhook: проверка секрета, /healthz и /metrics."""
+import asyncio
+import json
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+SECRET = "s3cret"
+UPDATE = {"update_id": 7, "message": {"message_id": 1, "date": 1, "text": "++",
+                                      "chat": {"id": -100, "type": "group"}}}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(requests, secret=SECRET):
+    """Запросы (метод, путь, тело, заголовки) к make_http_app; ответы и обновления, попавшие в очередь."""
+    from tornado.httpclient import AsyncHTTPClient
+
+    async def run():
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None, running=True)
+        port = free_port()
+        server = main.make_http_app(application, secret).listen(port, address="127.0.0.1")
+        client = AsyncHTTPClient()
+        responses = []
+        try:
+            for method, path, body, headers in requests:
+                response = await client.fetch(f"http://127.0.0.1:{port}{path}", method=method, body=body,
+                                              headers=headers, raise_error=False)
+                responses.append(response.code)
+        finally:
+            server.stop()
+        updates = []
+        while not application.update_queue.empty():
+            updates.append(application.update_queue.get_nowait())
+        return responses, updates
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+                                     {"X-Telegram-Bot-Api-Secret-Token": "sécret"}])
+def test_webhook_rejects_wrong_secret(headers):
+    responses, updates = serve([("POST", main.WEBHOOK_PATH, json.dumps(UPDATE), headers)])
+    assert responses == [403]
+    assert updates == []
+
+
+def test_webhook_accepts_updates_with_secret():
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    responses, updates = serve([("POST", main.WEBHOOK_PATH, json.dumps(UPDATE), headers),
+                                ("POST", main.WEBHOOK_PATH, "not json", headers)])
+    assert responses == [200, 400]
+    assert [update.update_id for update in updates] == [7]
+
+
+def test_without_secret_only_health_and_metrics():
+    responses, updates = serve([("POST", main.WEBHOOK_PATH, json.dumps(UPDATE), {}),
+                                ("GET", "/healthz", None, {}),
+                                ("GET", "/metrics", None, {})], secret=None)
+    assert responses == [404, 200, 200]
+    assert updates == []
+
+
+def test_webhook_secret_defaults_to_token_digest(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", None)
+    monkeypatch.setattr(main, "TOKEN", "123:abc")
+    derived = main.webhook_secret()
+    assert derived == main.webhook_secret() != "123:abc"
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    assert main.webhook_secret() == SECRET